@@ -0,0 +1,307 @@
+# coding: utf-8
+__author__ = 'https://github.com/ZFTurbo/'
+
+# Benchmarks for inference optimizations. All tests use synthetic mixture,
+# so they don't need any input audio.
+
+import argparse
+import copy
+from time import time
+
+import numpy as np
+import torch
+
+from inference import get_model_folder, get_demucs_model, apply_demucs, sdr, make_synthetic_mixture
+
+
+def get_benchmark_model(options):
+    if options['random_init']:
+        # same architecture as pretrained htdemucs, useful to check speed without downloading weights
+        from demucs4.htdemucs import HTDemucs
+        torch.manual_seed(0)
+        model = HTDemucs(['drums', 'bass', 'other', 'vocals'], segment=7.8)
+    else:
+        model = get_demucs_model(options['model'], get_model_folder(), 'cpu', vendored=True)
+    model.eval()
+    return model
+
+
+def benchmark_precision(options):
+    model = get_benchmark_model(options)
+    mixture, stems = make_synthetic_mixture(options['duration'])
+    audio = torch.from_numpy(mixture[None])
+
+    results = dict()
+    for precision in ['float32', options['precision']]:
+        # warm up
+        apply_demucs(model, audio[..., :44100], 0, 0.25, precision)
+        start_time = time()
+        with torch.no_grad():
+            out = apply_demucs(model, audio, 0, 0.25, precision)[0].numpy()
+        results[precision] = (time() - start_time, out)
+
+    time_float, out_float = results['float32']
+    for precision, (elapsed, out) in results.items():
+        sdr_ref = np.mean([sdr(stems[name], out[i]) for i, name in enumerate(model.sources) if name in stems])
+        print('{:>9}: Time: {:.2f} sec Speed up: {:.2f}x SDR: {:.3f} SDR vs float32: {:.2f}'.format(
+            precision, elapsed, time_float / elapsed, sdr_ref, np.mean(sdr(out_float, out))))
+
+
+def benchmark_fold_weights(options):
+    from demucs4.optimize import prepare_for_inference
+    model = get_benchmark_model(options)
+    folded = copy.deepcopy(model)
+    counts = prepare_for_inference(folded)
+    print('Folded modules: {} Total: {}'.format(counts, sum(counts.values())))
+    mixture, stems = make_synthetic_mixture(options['duration'])
+    audio = torch.from_numpy(mixture[None])
+
+    results = dict()
+    for name, m in [('original', model), ('folded', folded)]:
+        apply_demucs(m, audio[..., :44100], 0, 0.25)
+        start_time = time()
+        with torch.no_grad():
+            out = apply_demucs(m, audio, 0, 0.25)[0].numpy()
+        results[name] = (time() - start_time, out)
+
+    time_original, out_original = results['original']
+    for name, (elapsed, out) in results.items():
+        print('{:>9}: Time: {:.2f} sec Speed up: {:.2f}x Max diff: {:.2e} SDR vs original: {:.2f}'.format(
+            name, elapsed, time_original / elapsed, np.abs(out - out_original).max(), np.mean(sdr(out_original, out))))
+
+
+def openunmix_wiener(mag_out, mix_stft, niters, residual, wiener_win_len=300):
+    # reference: loop over samples and windows, as in original HDemucs._wiener
+    from openunmix.filtering import wiener
+    mag_out = mag_out.permute(0, 4, 3, 2, 1)
+    mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
+    outs = []
+    for sample in range(mag_out.shape[0]):
+        out = []
+        for pos in range(0, mag_out.shape[1], wiener_win_len):
+            frame = slice(pos, pos + wiener_win_len)
+            z_out = wiener(mag_out[sample, frame], mix_stft[sample, frame], niters, residual=residual)
+            out.append(z_out.transpose(-1, -2))
+        outs.append(torch.cat(out, dim=0))
+    out = torch.view_as_complex(torch.stack(outs, 0))
+    return out.permute(0, 4, 3, 2, 1).contiguous()
+
+
+def benchmark_wiener(options):
+    from demucs4.filtering import batched_wiener
+    # htdemucs shapes: 4 sources, 2048 bins, 336 frames per 7.8 sec segment
+    torch.manual_seed(0)
+    B, S, C, Fq, T = options['batch'], 4, 2, 2048, 336
+    mix_stft = torch.randn(B, C, Fq, T, dtype=torch.complex64)
+    mag_out = (mix_stft.abs()[:, None] * torch.rand(B, S, 1, Fq, T)).float()
+    for residual in [False, True]:
+        start_time = time()
+        ref = openunmix_wiener(mag_out, mix_stft, options['wiener_iters'], residual)
+        time_ref = time() - start_time
+        # default memory cap and the smallest one, which processes every window in a separate chunk
+        for max_memory in [None, 1]:
+            start_time = time()
+            out = batched_wiener(mag_out, mix_stft, options['wiener_iters'], residual=residual, max_memory=max_memory)
+            time_batched = time() - start_time
+            rel = ((out - ref).abs().max() / ref.abs().max()).item()
+            print('Residual: {} Max memory: {} OpenUnmix: {:.2f} sec Batched: {:.2f} sec Speed up: {:.2f}x Max relative diff: {:.2e}'.format(
+                residual, max_memory, time_ref, time_batched, time_ref / time_batched, rel))
+            if rel >= 1e-4:
+                raise ValueError('Batched wiener is different from OpenUnmix: max relative diff {:.2e}'.format(rel))
+
+
+def stitch_frames_loop(frames, stride, length):
+    # reference: original BLSTM stitching with slices of each frame and concatenation
+    limit = stride // 2
+    nframes = frames.shape[1]
+    out = []
+    for k in range(nframes):
+        if k == 0:
+            out.append(frames[:, k, :, :-limit])
+        elif k == nframes - 1:
+            out.append(frames[:, k, :, limit:])
+        else:
+            out.append(frames[:, k, :, limit:-limit])
+    return torch.cat(out, -1)[..., :length]
+
+
+def time_call(func, *args, runs=5):
+    start_time = time()
+    for _ in range(runs):
+        out = func(*args)
+    return (time() - start_time) / runs, out
+
+
+def benchmark_blstm(options):
+    from demucs4.demucs import BLSTM, stitch_frames
+    from demucs4.utils import unfold
+    # as in DConv of Demucs v3 models: hidden dim, 2 layers, frames of 200 steps,
+    # time steps after 4 encoder layers with stride 4
+    dim, steps_per_second = 96, 44100 / 4 ** 4
+    torch.manual_seed(0)
+    blstm = BLSTM(dim, layers=2, max_steps=200, skip=True).eval()
+    for seconds in [1, 5, 10, 30, 60]:
+        T = int(seconds * steps_per_second)
+        x = torch.randn(1, dim, T)
+        if T > blstm.max_steps:
+            frames = unfold(x, blstm.max_steps, blstm.max_steps // 2).permute(0, 2, 1, 3).contiguous()
+            time_loop, ref = time_call(stitch_frames_loop, frames, blstm.max_steps // 2, T)
+            time_stitch, out = time_call(stitch_frames, frames, blstm.max_steps // 2, T)
+            stitch_info = 'Stitch loop: {:.2f} ms Stitch: {:.2f} ms Speed up: {:.2f}x Equal: {}'.format(
+                1000 * time_loop, 1000 * time_stitch, time_loop / time_stitch, torch.equal(ref, out))
+        else:
+            stitch_info = 'Not framed'
+        with torch.no_grad():
+            time_forward, _ = time_call(blstm, x, runs=2)
+        print('{:>2} sec T: {:>5} Forward: {:.1f} ms {}'.format(seconds, T, 1000 * time_forward, stitch_info))
+
+
+def spectro_uncached(x, n_fft, hop_length):
+    # reference: window is created for every call, as in original spec.spectro/ispectro
+    *other, length = x.shape
+    z = torch.stft(x.reshape(-1, length), n_fft, hop_length, window=torch.hann_window(n_fft).to(x),
+                   win_length=n_fft, normalized=True, center=True, return_complex=True, pad_mode='reflect')
+    return z.view(*other, *z.shape[-2:])
+
+
+def ispectro_uncached(z, hop_length, length):
+    *other, freqs, frames = z.shape
+    n_fft = 2 * freqs - 2
+    x = torch.istft(z.reshape(-1, freqs, frames), n_fft, hop_length, window=torch.hann_window(n_fft).to(z.real),
+                    win_length=n_fft, normalized=True, length=length, center=True)
+    return x.view(*other, x.shape[-1])
+
+
+def benchmark_spectro(options):
+    from demucs4.spec import spectro, ispectro
+    from inference import Conv_TDF_net_trim_model
+    # htdemucs: 7.8 sec segments, nfft 4096, hop 1024
+    n_fft, hop, runs = 4096, 1024, 20
+    x = torch.randn(options['batch'], 2, int(7.8 * 44100))
+    seconds = runs * x.shape[0] * x.shape[-1] / 44100
+    for name, stft, istft in [('uncached', spectro_uncached, ispectro_uncached), ('cached', spectro, ispectro)]:
+        start_time = time()
+        for _ in range(runs):
+            z = stft(x, n_fft, hop)
+            out = istft(z, hop, x.shape[-1])
+        elapsed = time() - start_time
+        print('spectro/ispectro {:>8}: {:.1f} sec of audio per second Max error: {:.2e}'.format(
+            name, seconds / elapsed, (out - x).abs().max()))
+
+    # MDX models
+    model = Conv_TDF_net_trim_model('cpu', 'vocals', 11, 7680, hop=1024)
+    x = torch.randn(options['batch'], 2, model.chunk_size)
+    seconds = runs * x.shape[0] * x.shape[-1] / 44100
+    start_time = time()
+    for _ in range(runs):
+        out = model.istft(model.stft(x))
+    elapsed = time() - start_time
+    print('Conv_TDF stft/istft: {:.1f} sec of audio per second'.format(seconds / elapsed))
+
+
+def benchmark_validation(options):
+    from demucs4.utils import set_fast_inference
+    model = get_benchmark_model(options)
+    mixture, stems = make_synthetic_mixture(options['duration'])
+    audio = torch.from_numpy(mixture[None])
+    apply_demucs(model, audio[..., :44100], 0, 0.25)
+
+    results = dict()
+    for fast in [False, True]:
+        set_fast_inference(fast)
+        start_time = time()
+        with torch.no_grad():
+            out = apply_demucs(model, audio, 0, 0.25)
+        results[fast] = (time() - start_time, out)
+    set_fast_inference(False)
+
+    (time_validate, out_validate), (time_fast, out_fast) = results[False], results[True]
+    print('Validation: {:.2f} sec Fast inference: {:.2f} sec Speed up: {:.2f}x Bitwise identical: {}'.format(
+        time_validate, time_fast, time_validate / time_fast, torch.equal(out_validate, out_fast)))
+    if not torch.equal(out_validate, out_fast):
+        raise ValueError('Outputs with and without validation are different')
+
+
+def benchmark_shards(options):
+    from inference import EnsembleDemucsMDXMusicSeparationModel, separate_with_shards
+    # as in predict_with_model: parent only loads models, separation runs in forked workers
+    torch.set_num_threads(1)
+    model = EnsembleDemucsMDXMusicSeparationModel({'cpu': True, 'overlap_large': 0.6, 'overlap_small': 0.5})
+    mixture, stems = make_synthetic_mixture(options['duration'])
+    overlap = int(options['shard_overlap'] * 44100)
+
+    results = dict()
+    for shards in [1] + options['shards']:
+        start_time = time()
+        result, _, _ = separate_with_shards(model, mixture, 44100, shards, shards, overlap, False)
+        results[shards] = (time() - start_time, np.stack([result[name].T for name in model.instruments]))
+
+    # single shard is exactly the same as processing in one process
+    time_single, out_single = results[1]
+    for shards, (elapsed, out) in results.items():
+        print('Shards: {} Time: {:.2f} sec Speed up: {:.2f}x Scaling efficiency: {:.2f} Max diff: {:.2e} SDR vs 1 shard: {:.2f}'.format(
+            shards, elapsed, time_single / elapsed, time_single / elapsed / shards,
+            np.abs(out - out_single).max(), np.mean(sdr(out_single, out))))
+
+
+def benchmark_masks(options):
+    from demucs4.htdemucs import HTDemucs
+    from demucs4.transformer import mask_cache_info, clear_mask_cache
+    # htdemucs architecture with sparse attention, masks of all layers come from shared cache
+    torch.manual_seed(0)
+    model = HTDemucs(['drums', 'bass', 'other', 'vocals'], segment=7.8, t_sparse_self_attn=True,
+                     t_sparse_cross_attn=True, t_mask_type='diag', t_sparse_attn_window=100).eval()
+    mixture, stems = make_synthetic_mixture(options['duration'])
+    audio = torch.from_numpy(mixture[None])
+
+    clear_mask_cache()
+    for name in ['cold cache', 'warm cache']:
+        start_time = time()
+        with torch.no_grad():
+            apply_demucs(model, audio, 0, 0.25)
+        info = mask_cache_info()
+        print('{}: Time: {:.2f} sec Masks: {} Hits: {} Misses: {} Hit rate: {:.3f}'.format(
+            name, time() - start_time, info['size'], info['hits'], info['misses'], info['hit_rate']))
+
+
+BENCHMARKS = {
+    'precision': benchmark_precision,
+    'fold_weights': benchmark_fold_weights,
+    'wiener': benchmark_wiener,
+    'blstm': benchmark_blstm,
+    'spectro': benchmark_spectro,
+    'validation': benchmark_validation,
+    'shards': benchmark_shards,
+    'masks': benchmark_masks,
+}
+
+
+if __name__ == '__main__':
+    m = argparse.ArgumentParser()
+    m.add_argument("benchmark", type=str, choices=list(BENCHMARKS), help="Benchmark to run")
+    m.add_argument("--model", type=str, help="Demucs model to use. Default: htdemucs", default='htdemucs')
+    m.add_argument("--random_init", action='store_true', help="Use randomly initialized htdemucs instead of pretrained weights")
+    m.add_argument("--duration", type=float, help="Duration of synthetic benchmark clip in seconds. Default: 30", default=30.0)
+    m.add_argument("--precision", type=str, choices=['bfloat16', 'float16'], help="Reduced precision to compare with float32. Default: bfloat16", default='bfloat16')
+    m.add_argument("--wiener_iters", type=int, help="Number of EM iterations for wiener benchmark. Default: 1", default=1)
+    m.add_argument("--batch", type=int, help="Number of segments in batch for wiener and spectro benchmarks. Default: 2", default=2)
+    m.add_argument("--shards", nargs='+', type=int, help="Numbers of shards to compare with single process for shards benchmark. Default: 2 4", default=[2, 4])
+    m.add_argument("--shard_overlap", type=float, help="Overlap of shards in seconds for shards benchmark. Default: 10", default=10.0)
+
+    options = m.parse_args().__dict__
+    for el in options:
+        print('{}: {}'.format(el, options[el]))
+    BENCHMARKS[options['benchmark']](options)
+
+
+"""
+Example:
+    python benchmark.py precision --model htdemucs --precision bfloat16 --duration 30
+    python benchmark.py fold_weights --model htdemucs_ft
+    python benchmark.py wiener --wiener_iters 1 --batch 2
+    python benchmark.py blstm
+    python benchmark.py spectro --batch 2
+    python benchmark.py validation --model htdemucs
+    python benchmark.py shards --duration 600 --shards 2 4 8
+    python benchmark.py masks --duration 30
+"""
@@ -0,0 +1,76 @@
+# coding: utf-8
+__author__ = 'https://github.com/ZFTurbo/'
+
+# Converts Demucs checkpoints used in ensemble into flat weights format (demucs4/states.py).
+# Flat files have JSON header and raw aligned tensors, so inference.py with --mmap_weights
+# memory maps them instead of unpickling and copying every tensor. Pages of weights are read
+# on first use and shared between processes which load the same file.
+
+import os
+import argparse
+from time import time
+
+import torch
+from demucs.apply import BagOfModels
+
+from inference import get_model_folder, get_demucs_model, load_flat_model, DEMUCS_MODELS
+from demucs4.states import save_flat
+
+
+def convert_demucs_model(name, model_folder, output_folder):
+    print('Convert Demucs model: {}'.format(name))
+    start_time = time()
+    model = get_demucs_model(name, model_folder, 'cpu', vendored=True)
+    time_checkpoint = time() - start_time
+
+    path = output_folder + name + '.flat'
+    if isinstance(model, BagOfModels):
+        save_flat(list(model.models), path, meta={'bag': True, 'weights': model.weights})
+    else:
+        save_flat([model], path)
+
+    start_time = time()
+    flat = load_flat_model(path)
+    time_flat = time() - start_time
+
+    # check exactly what will be loaded later by inference.py
+    state, state_flat = model.state_dict(), flat.state_dict()
+    equal = state.keys() == state_flat.keys() and all(torch.equal(state[k], state_flat[k]) for k in state)
+    if not equal:
+        os.remove(path)
+        raise ValueError('Weights of {} are different after conversion'.format(name))
+    print('Size: {:.1f} MB Load time checkpoint: {:.2f} sec Flat: {:.2f} sec Equal: {}'.format(
+        os.path.getsize(path) / 2 ** 20, time_checkpoint, time_flat, equal))
+
+
+def convert_models(options):
+    model_folder = get_model_folder()
+    output_folder = model_folder + 'flat/'
+    if not os.path.isdir(output_folder):
+        os.mkdir(output_folder)
+
+    for name in options['models']:
+        if name in DEMUCS_MODELS:
+            convert_demucs_model(name, model_folder, output_folder)
+        else:
+            print('Unknown model: {}. Skip it'.format(name))
+
+
+if __name__ == '__main__':
+    start_time = time()
+
+    m = argparse.ArgumentParser()
+    m.add_argument("--models", nargs='+', type=str, help="Models to convert. Default: all Demucs models used in ensemble", default=DEMUCS_MODELS)
+
+    options = m.parse_args().__dict__
+    for el in options:
+        print('{}: {}'.format(el, options[el]))
+    convert_models(options)
+    print('Time: {:.0f} sec'.format(time() - start_time))
+
+
+"""
+Example:
+    python convert_weights.py --models htdemucs_ft htdemucs
+    python inference.py --input_audio mixture.wav --output_folder ./results/ --cpu --mmap_weights
+"""
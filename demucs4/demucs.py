@@ -4,6 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import math
 import typing as tp
 
@@ -49,24 +50,30 @@ class BLSTM(nn.Module):
         x = self.linear(x)
         x = x.permute(1, 2, 0)
         if framed:
-            out = []
-            frames = x.reshape(B, -1, C, width)
-            limit = stride // 2
-            for k in range(nframes):
-                if k == 0:
-                    out.append(frames[:, k, :, :-limit])
-                elif k == nframes - 1:
-                    out.append(frames[:, k, :, limit:])
-                else:
-                    out.append(frames[:, k, :, limit:-limit])
-            out = torch.cat(out, -1)
-            out = out[..., :T]
-            x = out
+            x = stitch_frames(x.reshape(B, nframes, C, width), stride, T)
         if self.skip:
             x = x + y
         return x
 
 
+def stitch_frames(frames, stride, length):
+    """
+    Inverse of `unfold` with width = 2 * stride, keeping only the middle half of each frame
+    (and the outer quarters of the first and the last frames). Output is written in a single
+    allocation instead of concatenating slices of each frame.
+    frames - (B, nframes, C, width)
+    Returns (B, C, length)
+    """
+    B, nframes, C, width = frames.shape
+    limit = stride // 2
+    out = frames.new_empty(B, C, nframes * stride + 2 * limit)
+    out[..., :limit] = frames[:, 0, :, :limit]
+    middle = out[..., limit:limit + nframes * stride].view(B, C, nframes, stride)
+    middle.copy_(frames[..., limit:width - limit].permute(0, 2, 1, 3))
+    out[..., limit + nframes * stride:] = frames[:, -1, :, width - limit:]
+    return out[..., :length]
+
+
 def rescale_conv(conv, reference):
     """Rescale initial weight scale. It is unclear why it helps but it certainly does.
     """
@@ -154,6 +161,15 @@ class DConv(nn.Module):
         return x
 
 
+# Number of queries processed at once by LocalState
+LOCAL_STATE_BLOCK_SIZE = 256
+
+
+@functools.lru_cache(maxsize=16)
+def _local_state_indexes(length, device, dtype):
+    return torch.arange(length, device=device, dtype=dtype)
+
+
 class LocalState(nn.Module):
     """Local state allows to have attention based only on data (no positional embedding),
     but while setting a constraint on the time window (e.g. decaying penalty term).
@@ -178,40 +194,56 @@ class LocalState(nn.Module):
             assert self.query_decay.bias is not None  # stupid type checker
             self.query_decay.bias.data[:] = -2
         self.proj = nn.Conv1d(channels + heads * nfreqs, channels, 1)
+        # set by prepare_for_inference when 1 / sqrt(channels) is folded into query weights
+        self.query_scaled = False
 
     def forward(self, x):
         B, C, T = x.shape
         heads = self.heads
-        indexes = torch.arange(T, device=x.device, dtype=x.dtype)
-        # left index are keys, right index are queries
-        delta = indexes[:, None] - indexes[None, :]
+        # kernels are computed in at least float32, positions can't be represented in half precision
+        indexes = _local_state_indexes(T, x.device, torch.promote_types(x.dtype, torch.float32))
 
         queries = self.query(x).view(B, heads, -1, T)
         keys = self.key(x).view(B, heads, -1, T)
-        # t are keys, s are queries
-        dots = torch.einsum("bhct,bhcs->bhts", keys, queries)
-        dots /= keys.shape[2]**0.5
+        content = self.content(x).view(B, heads, -1, T)
         if self.nfreqs:
-            periods = torch.arange(1, self.nfreqs + 1, device=x.device, dtype=x.dtype)
-            freq_kernel = torch.cos(2 * math.pi * delta / periods.view(-1, 1, 1))
+            periods = torch.arange(1, self.nfreqs + 1, device=x.device, dtype=indexes.dtype)
             freq_q = self.query_freqs(x).view(B, heads, -1, T) / self.nfreqs ** 0.5
-            dots += torch.einsum("fts,bhfs->bhts", freq_kernel, freq_q)
         if self.ndecay:
-            decays = torch.arange(1, self.ndecay + 1, device=x.device, dtype=x.dtype)
+            decays = torch.arange(1, self.ndecay + 1, device=x.device, dtype=indexes.dtype)
             decay_q = self.query_decay(x).view(B, heads, -1, T)
             decay_q = torch.sigmoid(decay_q) / 2
-            decay_kernel = - decays.view(-1, 1, 1) * delta.abs() / self.ndecay**0.5
-            dots += torch.einsum("fts,bhfs->bhts", decay_kernel, decay_q)
-
-        # Kill self reference.
-        dots.masked_fill_(torch.eye(T, device=dots.device, dtype=torch.bool), -100)
-        weights = torch.softmax(dots, dim=2)
 
-        content = self.content(x).view(B, heads, -1, T)
-        result = torch.einsum("bhts,bhct->bhcs", weights, content)
-        if self.nfreqs:
-            time_sig = torch.einsum("bhts,fts->bhfs", weights, freq_kernel)
-            result = torch.cat([result, time_sig], 2)
+        # Queries are processed by blocks, so only (T, block) attention weights and kernels
+        # exist at a time and memory is linear in T.
+        result = None
+        for start in range(0, T, LOCAL_STATE_BLOCK_SIZE):
+            block = slice(start, min(T, start + LOCAL_STATE_BLOCK_SIZE))
+            # left index are keys, right index are queries
+            delta = indexes[:, None] - indexes[None, block]
+
+            # t are keys, s are queries
+            dots = torch.einsum("bhct,bhcs->bhts", keys, queries[..., block])
+            if not self.query_scaled:
+                dots /= keys.shape[2]**0.5
+            if self.nfreqs:
+                freq_kernel = torch.cos(2 * math.pi * delta / periods.view(-1, 1, 1))
+                dots += torch.einsum("fts,bhfs->bhts", freq_kernel, freq_q[..., block])
+            if self.ndecay:
+                decay_kernel = - decays.view(-1, 1, 1) * delta.abs() / self.ndecay**0.5
+                dots += torch.einsum("fts,bhfs->bhts", decay_kernel, decay_q[..., block])
+
+            # Kill self reference.
+            dots[:, :, block].diagonal(dim1=2, dim2=3).fill_(-100)
+            weights = torch.softmax(dots, dim=2)
+
+            block_result = torch.einsum("bhts,bhct->bhcs", weights, content)
+            if self.nfreqs:
+                time_sig = torch.einsum("bhts,fts->bhfs", weights, freq_kernel)
+                block_result = torch.cat([block_result, time_sig], 2)
+            if result is None:
+                result = block_result.new_empty(block_result.shape[:3] + (T,))
+            result[..., block] = block_result
         result = result.reshape(B, -1, T)
         return x + self.proj(result)
 
@@ -435,7 +467,7 @@ class Demucs(nn.Module):
         x = x.view(x.size(0), len(self.sources), self.audio_channels, x.size(-1))
         return x
 
-    def load_state_dict(self, state, strict=True):
+    def load_state_dict(self, state, strict=True, assign=False):
         # fix a mismatch with previous generation Demucs models.
         for idx in range(self.depth):
             for a in ['encoder', 'decoder']:
@@ -444,4 +476,8 @@ class Demucs(nn.Module):
                     old = f'{a}.{idx}.2.{b}'
                     if old in state and new not in state:
                         state[new] = state.pop(old)
-        super().load_state_dict(state, strict=strict)
+        # assign is available only from torch 2.1, it's used only by flat weights loader
+        if assign:
+            super().load_state_dict(state, strict=strict, assign=True)
+        else:
+            super().load_state_dict(state, strict=strict)
@@ -0,0 +1,103 @@
+"""
+Batched version of Wiener filtering from OpenUnmix (`openunmix.filtering.wiener`), as it is
+used by HDemucs/HTDemucs: filtering with EM is applied independently on windows of frames.
+All samples and windows are processed together with native complex tensors, chunking is
+done only if it doesn't fit in WIENER_MAX_MEMORY.
+"""
+
+import torch
+
+# Approximate limit of memory used by one batch of windows, in bytes
+WIENER_MAX_MEMORY = 2 ** 28
+
+
+def _invert(M):
+    """
+    Inverts complex matrices with shape (..., C, C). 1x1 and 2x2 analytically, as OpenUnmix does.
+    """
+    C = M.shape[-1]
+    if C == 1:
+        return 1 / M
+    if C == 2:
+        a, b = M[..., 0, 0], M[..., 0, 1]
+        c, d = M[..., 1, 0], M[..., 1, 1]
+        inv_det = 1 / (a * d - b * c)
+        return torch.stack([
+            torch.stack([inv_det * d, -inv_det * b], dim=-1),
+            torch.stack([-inv_det * c, inv_det * a], dim=-1),
+        ], dim=-2)
+    return torch.linalg.inv(M)
+
+
+def _wiener_windows(mag, mix, niters, residual, scale_factor, eps):
+    """
+    mag - magnitude estimates, (N, T, Fr, S, C) where N is number of windows
+    mix - complex spectrogram of mix, (N, T, Fr, C)
+    Returns complex estimates (N, T, Fr, S, C), S + 1 sources if residual.
+    """
+    # initial estimates are magnitudes with phase of mix
+    phase = torch.angle(mix)[..., None, :]
+    y = torch.complex(mag * torch.cos(phase), mag * torch.sin(phase))
+    if residual:
+        y = torch.cat([y, mix[..., None, :] - y.sum(dim=-2, keepdim=True)], dim=-2)
+    if niters == 0:
+        return y
+
+    # scale down for numerical stability, separately for each window
+    max_abs = (mix.real ** 2 + mix.imag ** 2).flatten(1).max(dim=1).values.sqrt() / scale_factor
+    max_abs = max_abs.clamp(min=1.0).view(-1, 1, 1, 1)
+    mix = mix / max_abs
+    y = y / max_abs[..., None]
+
+    C = mix.shape[-1]
+    regularization = eps ** 0.5 * torch.eye(C, dtype=mix.dtype, device=mix.device)
+    for _ in range(niters):
+        # power spectral densities, (N, T, Fr, S)
+        v = (y.real ** 2 + y.imag ** 2).mean(dim=-1)
+        # spatial covariance matrices, weighted by PSD over frames, (N, Fr, S, C, C)
+        R = torch.einsum('ntfsc,ntfsd->nfscd', y, y.conj())
+        R = R / (eps + v.sum(dim=1))[..., None, None]
+        # mixture covariance, (N, T, Fr, C, C)
+        v = v.to(mix.dtype)
+        Cxx = regularization + torch.einsum('ntfs,nfscd->ntfcd', v, R)
+        # multichannel Wiener gain v_j R_j inv(Cxx) applied to mix, without building the gain
+        inv_mix = torch.einsum('ntfcd,ntfd->ntfc', _invert(Cxx), mix)
+        y = v[..., None] * torch.einsum('nfscd,ntfd->ntfsc', R, inv_mix)
+    return y * max_abs[..., None]
+
+
+def batched_wiener(mag_out, mix_stft, niters, residual=False, win_len=300,
+                   scale_factor=10.0, eps=1e-10, max_memory=None):
+    """
+    Same result as calling OpenUnmix `wiener` for each sample and each window of `win_len` frames.
+    mag_out - magnitude estimates, (B, S, C, Fr, T)
+    mix_stft - complex spectrogram of mix, (B, C, Fr, T)
+    Returns complex estimates (B, S, C, Fr, T), S + 1 sources if residual.
+    """
+    if max_memory is None:
+        max_memory = WIENER_MAX_MEMORY
+    B, S, C, Fr, T = mag_out.shape
+    out_sources = S + 1 if residual else S
+    mag = mag_out.permute(0, 4, 3, 1, 2)
+    mix = mix_stft.permute(0, 3, 2, 1)
+
+    outs = []
+    full = T // win_len * win_len
+    # full windows and the last shorter one, each group as a single batch
+    for start, stop, length in [(0, full, win_len), (full, T, T - full)]:
+        if stop == start:
+            continue
+        windows = (stop - start) // length
+        mag_windows = mag[:, start:stop].reshape(B * windows, length, Fr, S, C)
+        mix_windows = mix[:, start:stop].reshape(B * windows, length, Fr, C)
+        # complex estimates with a few temporaries of the same size
+        window_memory = 8 * length * Fr * out_sources * C * mix_stft.element_size()
+        chunk = max(1, max_memory // window_memory)
+        out = torch.cat([
+            _wiener_windows(mag_windows[pos:pos + chunk], mix_windows[pos:pos + chunk],
+                            niters, residual, scale_factor, eps)
+            for pos in range(0, B * windows, chunk)
+        ])
+        outs.append(out.view(B, stop - start, Fr, out_sources, C))
+    out = torch.cat(outs, dim=1)
+    return out.permute(0, 3, 4, 2, 1).contiguous()
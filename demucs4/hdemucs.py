@@ -10,13 +10,14 @@ from copy import deepcopy
 import math
 import typing as tp
 
-from openunmix.filtering import wiener
 import torch
 from torch import nn
 from torch.nn import functional as F
 
 from .demucs import DConv, rescale_module
 from .states import capture_init
+from .filtering import batched_wiener
+from .utils import float32_only, validation_enabled
 from .spec import spectro, ispectro
 
 
@@ -35,8 +36,9 @@ def pad1d(x: torch.Tensor, paddings: tp.Tuple[int, int], mode: str = 'constant',
             paddings = (padding_left - extra_pad_left, padding_right - extra_pad_right)
             x = F.pad(x, (extra_pad_left, extra_pad_right))
     out = F.pad(x, paddings, mode, value)
-    assert out.shape[-1] == length + padding_left + padding_right
-    assert (out[..., padding_left: padding_left + length] == x0).all()
+    if validation_enabled():
+        assert out.shape[-1] == length + padding_left + padding_right
+        assert (out[..., padding_left: padding_left + length] == x0).all()
     return out
 
 
@@ -137,7 +139,8 @@ class HEncLayer(nn.Module):
         if self.empty:
             return y
         if inject is not None:
-            assert inject.shape[-1] == y.shape[-1], (inject.shape, y.shape)
+            if validation_enabled():
+                assert inject.shape[-1] == y.shape[-1], (inject.shape, y.shape)
             if inject.dim() == 3 and y.dim() == 4:
                 inject = inject[:, :, None]
             y = y + inject
@@ -191,19 +194,25 @@ class MultiWrap(nn.Module):
                 if hasattr(m, 'reset_parameters'):
                     m.reset_parameters()
             self.layers.append(lay)
+        # band plans by number of input frequencies, see `_band_plan`
+        self._plans = {}
 
-    def forward(self, x, skip=None, length=None):
-        B, C, Fr, T = x.shape
-
+    def _band_plan(self, Fr):
+        """
+        Returns list of bands (start, limit, pad_before, pad_after, src_start, src_stop, dst_start)
+        and total number of output frequencies. Band input is x[:, :, start:limit] padded with
+        pad_before/pad_after, band output rows [src_start, src_stop) go to [dst_start, ...)
+        of the output. For the decoder, `stride` rows before dst_start overlap with the previous band.
+        """
         ratios = list(self.split_ratios) + [1]
         start = 0
-        outs = []
+        dst_start = 0
+        bands = []
         for ratio, layer in zip(ratios, self.layers):
             if self.conv:
                 pad = layer.kernel_size // 4
                 if ratio == 1:
                     limit = Fr
-                    frames = -1
                 else:
                     limit = int(round(Fr * ratio))
                     le = limit - start
@@ -215,37 +224,59 @@ class MultiWrap(nn.Module):
                         limit -= pad
                 assert limit - start > 0, (limit, start)
                 assert limit <= Fr, (limit, Fr)
-                y = x[:, :, start:limit, :]
-                if start == 0:
-                    y = F.pad(y, (0, 0, pad, 0))
-                if ratio == 1:
-                    y = F.pad(y, (0, 0, 0, pad))
-                outs.append(layer(y))
+                pad_before = pad if start == 0 else 0
+                pad_after = pad if ratio == 1 else 0
+                length = limit - start + pad_before + pad_after
+                src_stop = (length - layer.kernel_size) // layer.stride + 1
+                bands.append((start, limit, pad_before, pad_after, 0, src_stop, dst_start))
+                dst_start += src_stop
                 start = limit - layer.kernel_size + layer.stride
             else:
                 if ratio == 1:
                     limit = Fr
                 else:
                     limit = int(round(Fr * ratio))
-                last = layer.last
-                layer.last = True
-
-                y = x[:, :, start:limit]
-                s = skip[:, :, start:limit]
-                out, _ = layer(y, s, None)
-                if outs:
-                    outs[-1][:, :, -layer.stride:] += (
-                        out[:, :, :layer.stride] - layer.conv_tr.bias.view(1, -1, 1, 1))
-                    out = out[:, :, layer.stride:]
+                conv_tr = layer.conv_tr
+                length = ((limit - start - 1) * conv_tr.stride[0] - 2 * conv_tr.padding[0] +
+                          conv_tr.dilation[0] * (conv_tr.kernel_size[0] - 1) + conv_tr.output_padding[0] + 1)
+                src_start = layer.stride if bands else 0
+                src_stop = length
                 if ratio == 1:
-                    out = out[:, :, :-layer.stride // 2, :]
+                    src_stop -= layer.stride // 2
                 if start == 0:
-                    out = out[:, :, layer.stride // 2:, :]
-                outs.append(out)
-                layer.last = last
+                    src_start += layer.stride // 2
+                bands.append((start, limit, 0, 0, src_start, src_stop, dst_start))
+                dst_start += src_stop - src_start
                 start = limit
-        out = torch.cat(outs, dim=2)
-        if not self.conv and not last:
+        return bands, dst_start
+
+    def forward(self, x, skip=None, length=None):
+        B, C, Fr, T = x.shape
+
+        if Fr not in self._plans:
+            self._plans[Fr] = self._band_plan(Fr)
+        bands, total = self._plans[Fr]
+        # outputs of bands are written directly in preallocated output
+        out = None
+        for (start, limit, pad_before, pad_after, src_start, src_stop, dst_start), layer in zip(bands, self.layers):
+            y = x[:, :, start:limit]
+            if self.conv:
+                if pad_before or pad_after:
+                    y = F.pad(y, (0, 0, pad_before, pad_after))
+                z = layer(y)
+            else:
+                last = layer.last
+                layer.last = True
+                z, _ = layer(y, skip[:, :, start:limit], None)
+                layer.last = last
+            if out is None:
+                out = z.new_empty(B, z.shape[1], total, z.shape[3])
+            if not self.conv and src_start >= layer.stride:
+                # first rows of band overlap with the last rows of previous band
+                out[:, :, dst_start - layer.stride:dst_start] += (
+                    z[:, :, src_start - layer.stride:src_start] - layer.conv_tr.bias.view(1, -1, 1, 1))
+            out[:, :, dst_start:dst_start + src_stop - src_start] = z[:, :, src_start:src_stop]
+        if not self.conv and not self.layers[-1].last:
             out = F.gelu(out)
         if self.conv:
             return out
@@ -329,7 +360,8 @@ class HDecLayer(nn.Module):
                 z = z[..., self.pad:-self.pad, :]
         else:
             z = z[..., self.pad:self.pad + length]
-            assert z.shape[-1] == length, (z.shape[-1], length)
+            if validation_enabled():
+                assert z.shape[-1] == length, (z.shape[-1], length)
         if not self.last:
             z = F.gelu(z)
         return z, y
@@ -584,6 +616,7 @@ class HDemucs(nn.Module):
         if rescale:
             rescale_module(self, reference=rescale)
 
+    @float32_only
     def _spec(self, x):
         hl = self.hop_length
         nfft = self.nfft
@@ -607,15 +640,17 @@ class HDemucs(nn.Module):
 
         z = spectro(x, nfft, hl)[..., :-1, :]
         if self.hybrid:
-            assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
+            if validation_enabled():
+                assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
             z = z[..., 2:2+le]
         return z
 
+    @float32_only
     def _ispec(self, z, length=None, scale=0):
         hl = self.hop_length // (4 ** scale)
-        z = F.pad(z, (0, 0, 0, 1))
         if self.hybrid:
-            z = F.pad(z, (2, 2))
+            # frequency and time padding at once
+            z = F.pad(z, (2, 2, 0, 1))
             pad = hl // 2 * 3
             if not self.hybrid_old:
                 le = hl * int(math.ceil(length / hl)) + 2 * pad
@@ -627,6 +662,7 @@ class HDemucs(nn.Module):
             else:
                 x = x[..., :length]
         else:
+            z = F.pad(z, (0, 0, 0, 1))
             x = ispectro(z, hl, length)
         return x
 
@@ -658,32 +694,19 @@ class HDemucs(nn.Module):
         else:
             return self._wiener(m, z, niters)
 
+    @float32_only
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering from OpenUnmix, batched over samples and windows.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
 
         B, S, C, Fq, T = mag_out.shape
-        mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(B):
-            pos = 0
-            out = []
-            for pos in range(0, T, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame], mix_stft[sample, frame], niters,
-                    residual=residual)
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
-        out = out.permute(0, 4, 3, 2, 1).contiguous()
+        out = batched_wiener(mag_out, mix_stft, niters, residual=residual, win_len=wiener_win_len)
         if residual:
             out = out[:, :-1]
-        assert list(out.shape) == [B, S, C, Fq, T]
+        if validation_enabled():
+            assert list(out.shape) == [B, S, C, Fq, T]
         return out.to(init)
 
     def forward(self, mix):
@@ -697,6 +720,7 @@ class HDemucs(nn.Module):
         B, C, Fq, T = x.shape
 
         # unlike previous Demucs, we always normalize because it is easier.
+        # `_spec` is float32 only, so the statistics stay in float32 under autocast.
         mean = x.mean(dim=(1, 2, 3), keepdim=True)
         std = x.std(dim=(1, 2, 3), keepdim=True)
         x = (x - mean) / (1e-5 + std)
@@ -734,7 +758,8 @@ class HDemucs(nn.Module):
                 # add frequency embedding to allow for non equivariant convolutions
                 # over the frequency axis.
                 frs = torch.arange(x.shape[-2], device=x.device)
-                emb = self.freq_emb(frs).t()[None, :, :, None].expand_as(x)
+                # broadcast instead of expand, so scaling is done on (C, Fr) only
+                emb = self.freq_emb(frs).t()[None, :, :, None]
                 x = x + self.freq_emb_scale * emb
 
             saved.append(x)
@@ -756,7 +781,8 @@ class HDemucs(nn.Module):
                 tdec = self.tdecoder[idx - offset]
                 length_t = lengths_t.pop(-1)
                 if tdec.empty:
-                    assert pre.shape[2] == 1, pre.shape
+                    if validation_enabled():
+                        assert pre.shape[2] == 1, pre.shape
                     pre = pre[:, :, 0]
                     xt, _ = tdec(pre, None, length_t)
                 else:
@@ -764,9 +790,10 @@ class HDemucs(nn.Module):
                     xt, _ = tdec(xt, skip, length_t)
 
         # Let's make sure we used all stored skip connections.
-        assert len(saved) == 0
-        assert len(lengths_t) == 0
-        assert len(saved_t) == 0
+        if validation_enabled():
+            assert len(saved) == 0
+            assert len(lengths_t) == 0
+            assert len(saved_t) == 0
 
         S = len(self.sources)
         x = x.view(B, S, -1, Fq, T)
@@ -9,7 +9,6 @@ This code contains the spectrogram and Hybrid version of Demucs.
 """
 import math
 
-from openunmix.filtering import wiener
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -20,6 +19,8 @@ from .transformer import CrossTransformerEncoder
 
 from .demucs import rescale_module
 from .states import capture_init
+from .filtering import batched_wiener
+from .utils import float32_only, validation_enabled
 from .spec import spectro, ispectro
 from .hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer
 
@@ -417,6 +418,7 @@ class HTDemucs(nn.Module):
         else:
             self.crosstransformer = None
 
+    @float32_only
     def _spec(self, x):
         hl = self.hop_length
         nfft = self.nfft
@@ -435,14 +437,16 @@ class HTDemucs(nn.Module):
         x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
 
         z = spectro(x, nfft, hl)[..., :-1, :]
-        assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
+        if validation_enabled():
+            assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
         z = z[..., 2: 2 + le]
         return z
 
+    @float32_only
     def _ispec(self, z, length=None, scale=0):
         hl = self.hop_length // (4**scale)
-        z = F.pad(z, (0, 0, 0, 1))
-        z = F.pad(z, (2, 2))
+        # frequency and time padding at once
+        z = F.pad(z, (2, 2, 0, 1))
         pad = hl // 2 * 3
         le = hl * int(math.ceil(length / hl)) + 2 * pad
         x = ispectro(z, hl, length=le)
@@ -477,35 +481,19 @@ class HTDemucs(nn.Module):
         else:
             return self._wiener(m, z, niters)
 
+    @float32_only
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering from OpenUnmix, batched over samples and windows.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
 
         B, S, C, Fq, T = mag_out.shape
-        mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(B):
-            pos = 0
-            out = []
-            for pos in range(0, T, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame],
-                    mix_stft[sample, frame],
-                    niters,
-                    residual=residual,
-                )
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
-        out = out.permute(0, 4, 3, 2, 1).contiguous()
+        out = batched_wiener(mag_out, mix_stft, niters, residual=residual, win_len=wiener_win_len)
         if residual:
             out = out[:, :-1]
-        assert list(out.shape) == [B, S, C, Fq, T]
+        if validation_enabled():
+            assert list(out.shape) == [B, S, C, Fq, T]
         return out.to(init)
 
     def valid_length(self, length: int):
@@ -542,6 +530,7 @@ class HTDemucs(nn.Module):
         B, C, Fq, T = x.shape
 
         # unlike previous Demucs, we always normalize because it is easier.
+        # `_spec` is float32 only, so the statistics stay in float32 under autocast.
         mean = x.mean(dim=(1, 2, 3), keepdim=True)
         std = x.std(dim=(1, 2, 3), keepdim=True)
         x = (x - mean) / (1e-5 + std)
@@ -578,7 +567,8 @@ class HTDemucs(nn.Module):
                 # add frequency embedding to allow for non equivariant convolutions
                 # over the frequency axis.
                 frs = torch.arange(x.shape[-2], device=x.device)
-                emb = self.freq_emb(frs).t()[None, :, :, None].expand_as(x)
+                # broadcast instead of expand, so scaling is done on (C, Fr) only
+                emb = self.freq_emb(frs).t()[None, :, :, None]
                 x = x + self.freq_emb_scale * emb
 
             saved.append(x)
@@ -609,7 +599,8 @@ class HTDemucs(nn.Module):
                 tdec = self.tdecoder[idx - offset]
                 length_t = lengths_t.pop(-1)
                 if tdec.empty:
-                    assert pre.shape[2] == 1, pre.shape
+                    if validation_enabled():
+                        assert pre.shape[2] == 1, pre.shape
                     pre = pre[:, :, 0]
                     xt, _ = tdec(pre, None, length_t)
                 else:
@@ -617,9 +608,10 @@ class HTDemucs(nn.Module):
                     xt, _ = tdec(xt, skip, length_t)
 
         # Let's make sure we used all stored skip connections.
-        assert len(saved) == 0
-        assert len(lengths_t) == 0
-        assert len(saved_t) == 0
+        if validation_enabled():
+            assert len(saved) == 0
+            assert len(lengths_t) == 0
+            assert len(saved_t) == 0
 
         S = len(self.sources)
         x = x.view(B, S, -1, Fq, T)
@@ -0,0 +1,175 @@
+"""
+Inference-time preparation of Demucs models. Constant rescalings which are only
+useful during training (LayerScale, embedding learning rate boosts, affine params
+of pre-norms, attention temperature) are folded into adjacent conv/linear weights,
+where it is mathematically exact, and training-only branches are disabled.
+Prepared model must not be trained anymore: its state_dict differs from the original.
+"""
+
+import torch
+import torch.nn as nn
+
+from .demucs import DConv, LocalState
+from .hdemucs import ScaledEmbedding, HDemucs
+from .htdemucs import HTDemucs
+from .transformer import LayerScale, MyGroupNorm, MyTransformerEncoderLayer, \
+    CrossTransformerEncoderLayer, CrossTransformerEncoder, MultiheadAttention, \
+    ScaledEmbedding as TransformerScaledEmbedding
+
+
+def _scale_outputs(layer, scale, rows=slice(None)):
+    """
+    Multiplies output channels `rows` of conv/linear/affine norm by `scale`.
+    """
+    shape = [-1] + [1] * (layer.weight.dim() - 1)
+    layer.weight.data[rows] *= scale.view(shape)
+    if layer.bias is not None:
+        layer.bias.data[rows] *= scale
+
+
+def _fold_norm_affine(norm, weight, bias, rows=slice(None)):
+    """
+    Folds affine params of norm into the following linear layer given as
+    weight (out, in) and bias (out,) tensors, restricted to output `rows`.
+    Linear(n(x) * w + b) = (W * w) n(x) + (W b + c)
+    """
+    bias.data[rows] += weight.data[rows] @ norm.bias.data
+    weight.data[rows] *= norm.weight.data[None]
+
+
+def _is_affine(norm):
+    if isinstance(norm, nn.LayerNorm):
+        return norm.elementwise_affine
+    if isinstance(norm, nn.GroupNorm):
+        return norm.affine
+    return False
+
+
+def _plain_norm(norm):
+    if isinstance(norm, MyGroupNorm):
+        return MyGroupNorm(norm.num_groups, norm.num_channels, eps=norm.eps, affine=False)
+    return nn.LayerNorm(norm.normalized_shape, eps=norm.eps, elementwise_affine=False)
+
+
+def _attention_projections(attn, part):
+    """
+    Returns list of (weight, bias, rows) for input projections of attention.
+    part - 'q', 'kv' or 'qkv'
+    """
+    if isinstance(attn, MultiheadAttention):
+        layers = {'q': [attn.q], 'kv': [attn.k, attn.v], 'qkv': [attn.q, attn.k, attn.v]}[part]
+        return [(layer.weight, layer.bias, slice(None)) for layer in layers]
+    if not attn._qkv_same_embed_dim or attn.in_proj_bias is None:
+        return None
+    dim = attn.embed_dim
+    rows = {'q': slice(0, dim), 'kv': slice(dim, 3 * dim), 'qkv': slice(None)}[part]
+    return [(attn.in_proj_weight, attn.in_proj_bias, rows)]
+
+
+def _attention_output(attn):
+    if isinstance(attn, MultiheadAttention):
+        return attn.proj
+    return attn.out_proj
+
+
+def _fold_pre_norm(layer, name, projections):
+    norm = getattr(layer, name)
+    if projections is None or not _is_affine(norm):
+        return 0
+    for weight, bias, rows in projections:
+        _fold_norm_affine(norm, weight, bias, rows)
+    setattr(layer, name, _plain_norm(norm))
+    return 1
+
+
+def _fold_transformer_layer(layer, counts):
+    if isinstance(layer, MyTransformerEncoderLayer):
+        attn = layer.self_attn
+        norms = [('norm1', _attention_projections(attn, 'qkv')),
+                 ('norm2', [(layer.linear1.weight, layer.linear1.bias, slice(None))])]
+    else:
+        attn = layer.cross_attn
+        norms = [('norm1', _attention_projections(attn, 'q')),
+                 ('norm2', _attention_projections(attn, 'kv')),
+                 ('norm3', [(layer.linear1.weight, layer.linear1.bias, slice(None))])]
+
+    for name, output in [('gamma_1', _attention_output(attn)), ('gamma_2', layer.linear2)]:
+        gamma = getattr(layer, name)
+        if isinstance(gamma, LayerScale):
+            _scale_outputs(output, gamma.scale.data)
+            setattr(layer, name, nn.Identity())
+            counts['layer_scale'] += 1
+
+    # with post-norm, affine params are followed by residual, so can't be folded
+    if layer.norm_first:
+        for name, projections in norms:
+            counts['norm_affine'] += _fold_pre_norm(layer, name, projections)
+
+
+def _fold_dconv(dconv, counts):
+    for layer in dconv.layers:
+        # [..., conv1x1 (2C), norm (2C), GLU, LayerScale (C)]
+        if not isinstance(layer[-1], LayerScale):
+            continue
+        scale = layer[-1].scale.data
+        channels = scale.shape[0]
+        # GLU output is first half * sigmoid(second half), so scale goes to first half only
+        if isinstance(layer[-3], nn.GroupNorm) and layer[-3].affine:
+            _scale_outputs(layer[-3], scale, slice(0, channels))
+        elif isinstance(layer[-3], nn.Identity):
+            _scale_outputs(layer[-4], scale, slice(0, channels))
+        else:
+            continue
+        layer[-1] = nn.Identity()
+        counts['layer_scale'] += 1
+
+
+def prepare_for_inference(model):
+    """
+    Folds constant rescalings into weights in place and switches model to eval mode.
+    Works with single models and bags of models.
+    model - model built with demucs4 classes
+    Returns dict with number of folded or removed modules by type.
+    """
+    counts = {'layer_scale': 0, 'norm_affine': 0, 'embedding_scale': 0, 'attention_scale': 0, 'dropout': 0}
+    model.eval()
+    model.requires_grad_(False)
+
+    for module in list(model.modules()):
+        if isinstance(module, DConv):
+            _fold_dconv(module, counts)
+        elif isinstance(module, (MyTransformerEncoderLayer, CrossTransformerEncoderLayer)):
+            _fold_transformer_layer(module, counts)
+        elif isinstance(module, LocalState) and not module.query_scaled:
+            # dots are divided by sqrt of channels per head, it can be done on queries
+            channels = module.query.out_channels // module.heads
+            module.query.weight.data /= channels ** 0.5
+            module.query.bias.data /= channels ** 0.5
+            module.query_scaled = True
+            counts['attention_scale'] += 1
+        elif isinstance(module, ScaledEmbedding) and module.scale != 1:
+            module.embedding.weight.data *= module.scale
+            module.scale = 1
+            counts['embedding_scale'] += 1
+        elif isinstance(module, TransformerScaledEmbedding) and module.boost != 1:
+            module.embedding.weight.data *= module.boost
+            module.boost = 1
+            counts['embedding_scale'] += 1
+        elif isinstance(module, CrossTransformerEncoder):
+            # random positional shifts are augmentations
+            module.sin_random_shift = 0
+            if hasattr(module, 'cape_augment'):
+                module.cape_augment = False
+        elif isinstance(module, (HDemucs, HTDemucs)) and module.freq_emb is not None \
+                and module.freq_emb_scale != 1:
+            module.freq_emb.embedding.weight.data *= module.freq_emb_scale
+            module.freq_emb_scale = 1
+            counts['embedding_scale'] += 1
+
+    # dropout is identity in eval mode, but still costs a call per layer
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+                counts['dropout'] += 1
+    return counts
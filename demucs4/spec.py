@@ -5,16 +5,31 @@
 # LICENSE file in the root directory of this source tree.
 """Conveniance wrapper to perform STFT and iSTFT"""
 
+import functools
+
 import torch as th
 
 
+@functools.lru_cache(maxsize=32)
+def _cached_window(length, device, dtype):
+    return th.hann_window(length).to(device=device, dtype=dtype)
+
+
+def get_window(length, device, dtype=th.float32):
+    """
+    Returns periodic Hann window, cached per (length, device, dtype). Window is shared
+    by all callers, so it must not be modified in place.
+    """
+    return _cached_window(length, th.device(device), dtype)
+
+
 def spectro(x, n_fft=512, hop_length=None, pad=0):
     *other, length = x.shape
     x = x.reshape(-1, length)
     z = th.stft(x,
                 n_fft * (1 + pad),
                 hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
+                window=get_window(n_fft, x.device, x.dtype),
                 win_length=n_fft,
                 normalized=True,
                 center=True,
@@ -32,7 +47,7 @@ def ispectro(z, hop_length=None, length=None, pad=0):
     x = th.istft(z,
                  n_fft,
                  hop_length,
-                 window=th.hann_window(win_length).to(z.real),
+                 window=get_window(win_length, z.device, z.real.dtype),
                  win_length=win_length,
                  normalized=True,
                  length=length,
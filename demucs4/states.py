@@ -8,27 +8,43 @@ Utilities to save and load models.
 """
 from contextlib import contextmanager
 
+from fractions import Fraction
 import functools
 import hashlib
 import inspect
 import io
+import json
+import mmap
+import math
 from pathlib import Path
+import struct
 import warnings
 
 from omegaconf import OmegaConf
-from diffq import DiffQuantizer, UniformQuantizer, restore_quantized_state
 import torch
 
 
+def _check_diffq():
+    try:
+        import diffq  # noqa
+    except ImportError:
+        raise ImportError('Trying to use DiffQ, but diffq is not installed.\n'
+                          'Run: python -m pip install diffq')
+
+
 def get_quantizer(model, args, optimizer=None):
     """Return the quantizer given the XP quantization args."""
     quantizer = None
     if args.diffq:
+        _check_diffq()
+        from diffq import DiffQuantizer
         quantizer = DiffQuantizer(
             model, min_size=args.min_size, group_size=args.group_size)
         if optimizer is not None:
             quantizer.setup_optimizer(optimizer)
     elif args.qat:
+        _check_diffq()
+        from diffq import UniformQuantizer
         quantizer = UniformQuantizer(
                 model, bits=args.qat, min_size=args.min_size)
     return quantizer
@@ -67,6 +83,114 @@ def load_model(path_or_package, strict=False):
     return model
 
 
+# Flat weights format: magic, header length (uint64), JSON header with classes, init args
+# and tensor table, then raw tensors aligned to FLAT_ALIGNMENT bytes from the start of data.
+# Tensors can be memory mapped directly, without unpickling and copying.
+FLAT_MAGIC = b'DMXFLAT1'
+FLAT_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + FLAT_ALIGNMENT - 1) // FLAT_ALIGNMENT * FLAT_ALIGNMENT
+
+
+def _encode_arg(value):
+    if isinstance(value, Fraction):
+        return {'__fraction__': [value.numerator, value.denominator]}
+    if isinstance(value, (list, tuple)):
+        return [_encode_arg(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _encode_arg(v) for k, v in value.items()}
+    return value
+
+
+def _decode_arg(value):
+    if isinstance(value, dict):
+        if list(value) == ['__fraction__']:
+            return Fraction(*value['__fraction__'])
+        return {k: _decode_arg(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_arg(v) for v in value]
+    return value
+
+
+def save_flat(models, path, meta=None):
+    """Save list of models (Demucs, HDemucs or HTDemucs) in flat weights format.
+    `meta` is an optional JSON serializable dict stored in the header, e.g. bag weights.
+    Tensors are stored with the dtype of the model, so they can be used without conversion."""
+    header = {'meta': meta or {}, 'models': [], 'tensors': {}}
+    tensors = []
+    offset = 0
+    for index, model in enumerate(models):
+        args, kwargs = model._init_args_kwargs
+        header['models'].append({
+            'klass': model.__class__.__name__,
+            'args': _encode_arg(list(args)),
+            'kwargs': _encode_arg(kwargs),
+            'segment': _encode_arg(model.segment),
+        })
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            offset = _align(offset)
+            header['tensors'][f'{index}.{name}'] = {
+                'dtype': str(tensor.dtype).replace('torch.', ''),
+                'shape': list(tensor.shape),
+                'offset': offset,
+            }
+            tensors.append((offset, tensor))
+            offset += tensor.numel() * tensor.element_size()
+
+    header = json.dumps(header).encode()
+    data_start = _align(len(FLAT_MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(FLAT_MAGIC + struct.pack('<Q', len(header)) + header)
+        for offset, tensor in tensors:
+            f.write(b'\0' * (data_start + offset - f.tell()))
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def load_flat(path):
+    """Load models saved with `save_flat`. Models are built with classes from this package and
+    their tensors are bound to a copy-on-write memory map of the file, so there is no unpickling
+    or copying, pages are read on first use and shared between processes until modified.
+    Returns list of models in eval mode and meta dict."""
+    from .demucs import Demucs
+    from .hdemucs import HDemucs
+    from .htdemucs import HTDemucs
+    klasses = {'Demucs': Demucs, 'HDemucs': HDemucs, 'HTDemucs': HTDemucs}
+
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if buffer[:len(FLAT_MAGIC)] != FLAT_MAGIC:
+        raise ValueError(f"{path} is not in flat weights format.")
+    header_length, = struct.unpack('<Q', buffer[len(FLAT_MAGIC):len(FLAT_MAGIC) + 8])
+    header = json.loads(buffer[len(FLAT_MAGIC) + 8:len(FLAT_MAGIC) + 8 + header_length])
+    data_start = _align(len(FLAT_MAGIC) + 8 + header_length)
+
+    states = [dict() for _ in header['models']]
+    for key, info in header['tensors'].items():
+        index, name = key.split('.', 1)
+        dtype = getattr(torch, info['dtype'])
+        count = math.prod(info['shape'])
+        if count == 0:
+            tensor = torch.empty(info['shape'], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(
+                buffer, dtype=dtype, count=count, offset=data_start + info['offset']).view(info['shape'])
+        states[int(index)][name] = tensor
+
+    models = []
+    for info, state in zip(header['models'], states):
+        klass = klasses[info['klass']]
+        model = klass(*_decode_arg(info['args']), **_decode_arg(info['kwargs']))
+        # parameters initialized by constructor are replaced by views of the file and freed
+        model.load_state_dict(state, assign=True)
+        model.segment = _decode_arg(info['segment'])
+        model.eval()
+        models.append(model)
+    return models, header['meta']
+
+
 def get_state(model, quantizer, half=False):
     """Get the state from a model, potentially with quantization applied.
     If `half` is True, model are stored as half precision, which shouldn't impact performance
@@ -86,6 +210,8 @@ def set_state(model, state, quantizer=None):
         if quantizer is not None:
             quantizer.restore_quantized_state(model, state['quantized'])
         else:
+            _check_diffq()
+            from diffq import restore_quantized_state
             restore_quantized_state(model, state)
     else:
         model.load_state_dict(state)
@@ -5,6 +5,8 @@
 # LICENSE file in the root directory of this source tree.
 # First author is Simon Rouard.
 
+import functools
+import importlib.util
 import random
 import typing as tp
 
@@ -115,6 +117,40 @@ def create_sin_embedding_cape(
     ).float()
 
 
+# Positional embeddings depend only on shapes and constant params, and shapes are the same
+# for every segment during inference. Tables are built once per process and shared by all
+# layers and models. Cached tables must not be modified in place.
+EMBEDDING_CACHE_SIZE = 64
+
+
+@functools.lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _cached_sin_embedding(length, dim, shift, device, max_period):
+    return create_sin_embedding(length, dim, shift=shift, device=device, max_period=max_period)
+
+
+@functools.lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _cached_2d_sin_embedding(d_model, height, width, device, max_period):
+    """
+    Returns table already flattened as (1, width * height, d_model)
+    """
+    pos_emb_2d = create_2d_sin_embedding(d_model, height, width, device, max_period)
+    return rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c").contiguous()
+
+
+@functools.lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _cached_sin_embedding_cape(length, dim, batch_size, mean_normalize, device, max_period):
+    # only without augmentation, which is random
+    return create_sin_embedding_cape(
+        length, dim, batch_size, mean_normalize=mean_normalize, augment=False,
+        device=device, max_period=max_period,
+    )
+
+
+def clear_embedding_cache():
+    for cached in [_cached_sin_embedding, _cached_2d_sin_embedding, _cached_sin_embedding_cape]:
+        cached.cache_clear()
+
+
 def get_causal_mask(length):
     pos = torch.arange(length)
     return pos > pos[:, None]
@@ -175,6 +211,67 @@ def get_elementary_mask(
     return mask
 
 
+# Backend for masked and dynamic sparse attention:
+# "xformers" - sparse kernels from xformers (original implementation)
+# "torch" - pure PyTorch: block-local attention with gathered keys for masks built by get_mask,
+#     dense attention instead of dynamic sparse attention. Uses fused scaled_dot_product_attention
+#     of torch >= 2.0, softmax(QK^T)V otherwise.
+# "auto" - xformers if it is installed, torch otherwise
+ATTENTION_BACKENDS = ["auto", "xformers", "torch"]
+_attention_backend = "auto"
+# Number of queries processed together by block-local attention
+ATTENTION_BLOCK_SIZE = 128
+
+
+def set_attention_backend(backend):
+    global _attention_backend
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(
+            "Unknown attention backend {}. Available: {}".format(backend, ATTENTION_BACKENDS)
+        )
+    _attention_backend = backend
+
+
+@functools.lru_cache(maxsize=None)
+def _has_xformers():
+    return importlib.util.find_spec("xformers") is not None
+
+
+def get_attention_backend():
+    if _attention_backend == "auto":
+        return "xformers" if _has_xformers() else "torch"
+    return _attention_backend
+
+
+class BlockSparseMask:
+    """
+    Boolean attention mask of shape (T2, T1) (True - query attends key) for torch backend,
+    with plan for block-local attention: for each block of queries only keys which are used
+    by at least one of them are gathered. If the mask is not sparse enough for this to pay off,
+    dense masked attention is used.
+    """
+
+    def __init__(self, mask, block_size=ATTENTION_BLOCK_SIZE):
+        T2, T1 = mask.shape
+        self.mask = mask
+        self.shape = (1, T2, T1)
+        self.blocks = []
+        cost = 0
+        for start in range(0, T2, block_size):
+            block_mask = mask[start: start + block_size]
+            keys = block_mask.any(dim=0).nonzero()[:, 0]
+            self.blocks.append((start, start + block_mask.shape[0], keys, block_mask[:, keys]))
+            cost += block_mask.shape[0] * keys.shape[0]
+        self.dense = cost > 0.5 * T1 * T2
+        if self.dense:
+            self.blocks = []
+
+
+# Masks are shared by all layers of all models in the process. With fixed segment
+# length only a couple of (T1, T2) pairs are used, so mask construction is done once.
+MASK_CACHE_SIZE = 32
+
+
 def get_mask(
     T1,
     T2,
@@ -188,8 +285,53 @@ def get_mask(
     """
     Return a SparseCSRTensor mask that is a combination of elementary masks
     mask_type can be a combination of multiple masks: for instance "diag_jmask_random"
+    With torch attention backend BlockSparseMask is returned instead.
+    Masks are cached, they must not be modified in place.
     """
-    from xformers.sparse import SparseCSRTensor
+    return _cached_mask(
+        T1,
+        T2,
+        mask_type,
+        sparse_attn_window,
+        global_window,
+        mask_random_seed,
+        sparsity,
+        torch.device(device),
+        get_attention_backend(),
+    )
+
+
+def mask_cache_info():
+    """
+    Returns dict with number of cached masks, hits, misses and hit rate.
+    """
+    info = _cached_mask.cache_info()
+    total = info.hits + info.misses
+    return {
+        "size": info.currsize,
+        "max_size": info.maxsize,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / total if total else 0.0,
+    }
+
+
+def clear_mask_cache():
+    _cached_mask.cache_clear()
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def _cached_mask(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+    backend,
+):
     # create a list
     mask_types = mask_type.split("_")
 
@@ -209,6 +351,9 @@ def get_mask(
 
     final_mask = torch.stack(all_masks).sum(axis=0) > 0
 
+    if backend == "torch":
+        return BlockSparseMask(final_mask)
+    from xformers.sparse import SparseCSRTensor
     return SparseCSRTensor.from_dense(final_mask[None])
 
 
@@ -339,26 +484,25 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
     def forward(self, src, src_mask=None, src_key_padding_mask=None):
         """
         if batch_first = False, src shape is (T, B, C)
-        the case where batch_first=True is not covered
+        if batch_first = True, src shape is (B, T, C)
         """
         device = src.device
         x = src
-        T, B, C = x.shape
+        T = x.shape[1] if self.self_attn.batch_first else x.shape[0]
         if self.sparse and not self.auto_sparsity:
             assert src_mask is None
-            src_mask = self.src_mask
-            if src_mask.shape[-1] != T:
-                src_mask = get_mask(
-                    T,
-                    T,
-                    self.mask_type,
-                    self.sparse_attn_window,
-                    self.global_window,
-                    self.mask_random_seed,
-                    self.sparsity,
-                    device,
-                )
-                self.__setattr__("src_mask", src_mask)
+            # masks are cached by get_mask, so lookup is cheap and follows attention backend
+            src_mask = get_mask(
+                T,
+                T,
+                self.mask_type,
+                self.sparse_attn_window,
+                self.global_window,
+                self.mask_random_seed,
+                self.sparsity,
+                device,
+            )
+            self.__setattr__("src_mask", src_mask)
 
         if self.norm_first:
             x = x + self.gamma_1(
@@ -466,29 +610,29 @@ class CrossTransformerEncoderLayer(nn.Module):
     def forward(self, q, k, mask=None):
         """
         Args:
-            q: tensor of shape (T, B, C)
-            k: tensor of shape (S, B, C)
+            q: tensor of shape (T, B, C), or (B, T, C) if batch_first
+            k: tensor of shape (S, B, C), or (B, S, C) if batch_first
             mask: tensor of shape (T, S)
 
         """
         device = q.device
-        T, B, C = q.shape
-        S, B, C = k.shape
+        time_dim = 1 if self.cross_attn.batch_first else 0
+        T = q.shape[time_dim]
+        S = k.shape[time_dim]
         if self.sparse and not self.auto_sparsity:
             assert mask is None
-            mask = self.mask
-            if mask.shape[-1] != S or mask.shape[-2] != T:
-                mask = get_mask(
-                    S,
-                    T,
-                    self.mask_type,
-                    self.sparse_attn_window,
-                    self.global_window,
-                    self.mask_random_seed,
-                    self.sparsity,
-                    device,
-                )
-                self.__setattr__("mask", mask)
+            # masks are cached by get_mask, so lookup is cheap and follows attention backend
+            mask = get_mask(
+                S,
+                T,
+                self.mask_type,
+                self.sparse_attn_window,
+                self.global_window,
+                self.mask_random_seed,
+                self.sparsity,
+                device,
+            )
+            self.__setattr__("mask", mask)
 
         if self.norm_first:
             x = q + self.gamma_1(self._ca_block(self.norm1(q), self.norm2(k), mask))
@@ -647,10 +791,9 @@ class CrossTransformerEncoder(nn.Module):
 
     def forward(self, x, xt):
         B, C, Fr, T1 = x.shape
-        pos_emb_2d = create_2d_sin_embedding(
+        pos_emb_2d = _cached_2d_sin_embedding(
             C, Fr, T1, x.device, self.max_period
-        )  # (1, C, Fr, T1)
-        pos_emb_2d = rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c")
+        )  # (1, T1 * Fr, C)
         x = rearrange(x, "b c fr t1 -> b (t1 fr) c")
         x = self.norm_in(x)
         x = x + self.weight_pos_embed * pos_emb_2d
@@ -678,9 +821,7 @@ class CrossTransformerEncoder(nn.Module):
     def _get_pos_embedding(self, T, B, C, device):
         if self.emb == "sin":
             shift = random.randrange(self.sin_random_shift + 1)
-            pos_emb = create_sin_embedding(
-                T, C, shift=shift, device=device, max_period=self.max_period
-            )
+            pos_emb = _cached_sin_embedding(T, C, shift, device, self.max_period)
         elif self.emb == "cape":
             if self.training:
                 pos_emb = create_sin_embedding_cape(
@@ -696,14 +837,8 @@ class CrossTransformerEncoder(nn.Module):
                     max_scale=self.cape_glob_loc_scale[2],
                 )
             else:
-                pos_emb = create_sin_embedding_cape(
-                    T,
-                    C,
-                    B,
-                    device=device,
-                    max_period=self.max_period,
-                    mean_normalize=self.cape_mean_normalize,
-                    augment=False,
+                pos_emb = _cached_sin_embedding_cape(
+                    T, C, B, self.cape_mean_normalize, device, self.max_period
                 )
 
         elif self.emb == "scaled":
@@ -757,6 +892,7 @@ class MultiheadAttention(nn.Module):
         need_weights=True,
         attn_mask=None,
         average_attn_weights=True,
+        is_causal=False,
     ):
 
         if not self.batch_first:  # N, B, C
@@ -808,7 +944,46 @@ def scaled_query_key_softmax(q, k, att_mask):
     return att
 
 
+def _attention(q, k, v, attn_mask=None, dropout_p=0.0):
+    """
+    F.scaled_dot_product_attention, with the same computation for torch < 2.0 where it doesn't exist.
+    attn_mask - boolean (True - query attends key) or float mask added to scores, or None
+    """
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    att = (q / q.size(-1) ** 0.5) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            att = att.masked_fill(~attn_mask, float("-inf"))
+        else:
+            att = att + attn_mask
+    att = torch.softmax(att, -1)
+    if dropout_p > 0:
+        att = F.dropout(att, dropout_p)
+    return att @ v
+
+
+def block_sparse_attention(q, k, v, att_mask, dropout_p=0.0):
+    """
+    q: (B, N_q, D), k, v: (B, N_k, D), att_mask: BlockSparseMask of shape (1, N_q, N_k)
+    """
+    if att_mask.dense:
+        return _attention(q, k, v, attn_mask=att_mask.mask, dropout_p=dropout_p)
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for start, end, keys, block_mask in att_mask.blocks:
+        out[:, start:end] = _attention(
+            q[:, start:end], k[:, keys], v[:, keys], attn_mask=block_mask, dropout_p=dropout_p
+        )
+    return out
+
+
 def scaled_dot_product_attention(q, k, v, att_mask, dropout):
+    if get_attention_backend() == "torch":
+        # dropout can be replaced with identity by prepare_for_inference
+        dropout_p = getattr(dropout, "p", 0.0) if dropout.training else 0.0
+        if att_mask is None:
+            return _attention(q, k, v, dropout_p=dropout_p)
+        return block_sparse_attention(q, k, v, att_mask, dropout_p)
     att = scaled_query_key_softmax(q, k, att_mask=att_mask)
     att = dropout(att)
     y = att @ v
@@ -825,6 +1000,9 @@ def _compute_buckets(x, R):
 
 def dynamic_sparse_attention(query, key, value, sparsity, infer_sparsity=True, attn_bias=None):
     # assert False, "The code for the custom sparse kernel is not ready for release yet."
+    if get_attention_backend() == "torch":
+        # no sparse kernels, so exact dense attention is used
+        return _attention(query, key, value, attn_mask=attn_bias)
     from xformers.ops import find_locations, sparse_memory_efficient_attention
     n_hashes = 32
     proj_size = 4
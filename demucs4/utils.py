@@ -6,6 +6,7 @@
 
 from collections import defaultdict
 from contextlib import contextmanager
+import functools
 import math
 import os
 import tempfile
@@ -16,6 +17,48 @@ from torch.nn import functional as F
 from torch.utils.data import Subset
 
 
+# Validation asserts in hot paths (padding, forward of models, Wiener filtering) can be
+# turned off for inference with DEMUCS4_FAST_INFERENCE=1 or set_fast_inference(True).
+# They only check invariants, so outputs are the same either way.
+_fast_inference = os.environ.get('DEMUCS4_FAST_INFERENCE', '0') == '1'
+
+
+def set_fast_inference(enabled=True):
+    global _fast_inference
+    _fast_inference = bool(enabled)
+
+
+def validation_enabled():
+    return not _fast_inference
+
+
+def _to_float32(x):
+    if isinstance(x, torch.Tensor) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+def float32_only(func):
+    """Decorator to run `func` in float32, even when the model is evaluated under autocast.
+    Half precision tensors given as arguments are cast to float32 first.
+    Used for the numerically sensitive parts (STFT, iSTFT, Wiener filtering).
+    """
+    @functools.wraps(func)
+    def _func(*args, **kwargs):
+        args = [_to_float32(arg) for arg in args]
+        kwargs = {key: _to_float32(value) for key, value in kwargs.items()}
+        if not hasattr(torch, 'autocast'):
+            return func(*args, **kwargs)
+        device_type = 'cpu'
+        for arg in args + list(kwargs.values()):
+            if isinstance(arg, torch.Tensor):
+                device_type = arg.device.type
+                break
+        with torch.autocast(device_type, enabled=False):
+            return func(*args, **kwargs)
+    return _func
+
+
 def unfold(a, kernel_size, stride):
     """Given input of size [*OT, T], output Tensor of size [*OT, F, K]
     with K the kernel size, by extracting frames with the given stride.
@@ -4,7 +4,6 @@ from PyQt6.QtCore import *
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import *
 from inference import predict_with_model, __VERSION__
-import torch
 
 root = {}
 
@@ -405,6 +404,9 @@ def initialize_settings():
     root['only_vocals'] = False
     root['dark_theme'] = True
 
+def detect_gpu_settings():
+    # torch takes seconds to import, so it's done after window is shown
+    import torch
     if torch.cuda.is_available():
         total_memory = torch.cuda.get_device_properties(0).total_memory / (1024 ** 3)
         if total_memory > 11.5:
@@ -421,6 +423,7 @@ def main():
     app.setStyle('Fusion')
     window = MainWindow()
     window.show()
+    QTimer.singleShot(0, detect_gpu_settings)
     sys.exit(app.exec())
 
 if __name__ == '__main__':
@@ -3,35 +3,77 @@ __author__ = 'https://github.com/ZFTurbo/'
 
 if __name__ == '__main__':
     import os
+    import sys
+
+    STREAM_STDOUT = None
+    if '--stream' in sys.argv:
+        # stdout carries audio, so logs of Python and native libraries are moved to stderr
+        # before anything is printed, audio goes to duplicate of original stdout
+        STREAM_STDOUT = os.fdopen(os.dup(1), 'wb')
+        os.dup2(2, 1)
 
     gpu_use = "0"
     print('GPU use: {}'.format(gpu_use))
     os.environ["CUDA_VISIBLE_DEVICES"] = "{}".format(gpu_use)
 
 
+from time import time, sleep
+import sys
+import functools
+import importlib
+import importlib.util
 import numpy as np
-import torch
-import torch.nn as nn
 import os
 import argparse
-import soundfile as sf
-
-from demucs.states import load_model
-from demucs import pretrained
-from demucs.apply import apply_model
-import onnxruntime as ort
-from time import time
-import librosa
+import glob
 import hashlib
+import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import shutil
+import socket
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def lazy_import(name):
+    """
+    Returns module which is really imported at first access to its attributes.
+    Heavy modules (torch, onnxruntime, librosa) take seconds to import, it's not needed for --help or GUI start up.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+torch = lazy_import('torch')
+sf = lazy_import('soundfile')
+ort = lazy_import('onnxruntime')
+librosa = lazy_import('librosa')
 
 
 __VERSION__ = '1.0.1'
 
+# heavy modules, used by --profile_startup. torch touches optional dependencies during
+# its import, so they go before it to have their own time
+STARTUP_MODULES = ['soundfile', 'librosa', 'onnxruntime', 'torch', 'demucs.apply', 'demucs.pretrained', 'demucs4.htdemucs']
 
-class Conv_TDF_net_trim_model(nn.Module):
-    def __init__(self, device, target_name, L, n_fft, hop=1024):
 
-        super(Conv_TDF_net_trim_model, self).__init__()
+class Conv_TDF_net_trim_model:
+    """
+    STFT settings of MDX models. Network itself runs in onnxruntime, so it's not nn.Module.
+    """
+    def __init__(self, device, target_name, L, n_fft, hop=1024):
+        from demucs4.spec import get_window
 
         self.dim_c = 4
         self.dim_f, self.dim_t = 3072, 256
@@ -39,7 +81,8 @@ class Conv_TDF_net_trim_model(nn.Module):
         self.hop = hop
         self.n_bins = self.n_fft // 2 + 1
         self.chunk_size = hop * (self.dim_t - 1)
-        self.window = torch.hann_window(window_length=self.n_fft, periodic=True).to(device)
+        # shared by all models with the same n_fft
+        self.window = get_window(self.n_fft, device)
         self.target_name = target_name
 
         out_c = self.dim_c * 4 if target_name == '*' else self.dim_c
@@ -56,7 +99,8 @@ class Conv_TDF_net_trim_model(nn.Module):
         return x[:, :, :self.dim_f]
 
     def istft(self, x, freq_pad=None):
-        freq_pad = self.freq_pad.repeat([x.shape[0], 1, 1, 1]) if freq_pad is None else freq_pad
+        # expand doesn't copy, zeros are copied only once by cat
+        freq_pad = self.freq_pad.expand([x.shape[0], -1, -1, -1]) if freq_pad is None else freq_pad
         x = torch.cat([x, freq_pad], -2)
         x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape([-1, 2, self.n_bins, self.dim_t])
         x = x.permute([0, 2, 3, 1])
@@ -65,26 +109,6 @@ class Conv_TDF_net_trim_model(nn.Module):
         x = torch.istft(x, n_fft=self.n_fft, hop_length=self.hop, window=self.window, center=True)
         return x.reshape([-1, 2, self.chunk_size])
 
-    def forward(self, x):
-        x = self.first_conv(x)
-        x = x.transpose(-1, -2)
-
-        ds_outputs = []
-        for i in range(self.n):
-            x = self.ds_dense[i](x)
-            ds_outputs.append(x)
-            x = self.ds[i](x)
-
-        x = self.mid_dense(x)
-        for i in range(self.n):
-            x = self.us[i](x)
-            x *= ds_outputs[-i - 1]
-            x = self.us_dense[i](x)
-
-        x = x.transpose(-1, -2)
-        x = self.final_conv(x)
-        return x
-
 
 def get_models(name, device, load=True, vocals_model_type=0):
     if vocals_model_type == 2:
@@ -105,6 +129,294 @@ def get_models(name, device, load=True, vocals_model_type=0):
     return [model_vocals]
 
 
+DEMUCS_VOCALS_MODEL = '04573f0d-f3cf25b2'
+DEMUCS_MODELS = [DEMUCS_VOCALS_MODEL, 'htdemucs_ft', 'htdemucs', 'htdemucs_6s', 'hdemucs_mmi']
+DEMUCS_VOCALS_URL = 'https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th'
+ONNX_MODELS_URL = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/'
+
+
+def get_model_folder():
+    return os.path.dirname(os.path.realpath(__file__)) + '/models/'
+
+
+def torch_load(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # old torch versions don't have weights_only argument
+        return torch.load(path, map_location='cpu')
+
+
+def get_quantized_path(model_folder, name, ext):
+    """
+    Returns path to INT8 version of model created by quantize.py or None if it's not available.
+    Artifact is only used if it passed accuracy gate and was created with the same torch version.
+    """
+    path = model_folder + 'quantized/' + name + '.int8' + ext
+    if not os.path.isfile(path) or not os.path.isfile(path + '.json'):
+        print('No quantized version of {}. Run quantize.py first. Use float model'.format(name))
+        return None
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    if not meta['gate_passed']:
+        print('Quantized model {} failed accuracy gate (SDR drop: {:.3f}). Use float model'.format(
+            path, meta['gate']['sdr_drop']))
+        return None
+    if ext == '.th' and meta['torch_version'] != torch.__version__:
+        print('Quantized model {} created with torch {}. Use float model'.format(path, meta['torch_version']))
+        return None
+    return path
+
+
+def get_vendored_model(model):
+    """
+    Rebuilds model from demucs package with the same class from vendored demucs4 folder,
+    which keeps numerically sensitive parts in float32 under autocast.
+    Bags of models are rebuilt member by member.
+    """
+    from demucs.apply import BagOfModels
+    from demucs4.demucs import Demucs
+    from demucs4.hdemucs import HDemucs
+    from demucs4.htdemucs import HTDemucs
+
+    if isinstance(model, BagOfModels):
+        for i, sub_model in enumerate(model.models):
+            model.models[i] = get_vendored_model(sub_model)
+        return model
+    if type(model).__module__.startswith('demucs4.'):
+        # already vendored, e.g. loaded from flat weights
+        return model
+    klasses = {'Demucs': Demucs, 'HDemucs': HDemucs, 'HTDemucs': HTDemucs}
+    klass = klasses.get(type(model).__name__)
+    if klass is None or not hasattr(model, '_init_args_kwargs'):
+        return model
+    args, kwargs = model._init_args_kwargs
+    vendored = klass(*args, **kwargs)
+    vendored.load_state_dict(model.state_dict())
+    # segment can be overridden by bag of models
+    vendored.segment = model.segment
+    return vendored
+
+
+def get_flat_path(model_folder, name):
+    """
+    Returns path to flat weights of model created by convert_weights.py or None if it's not available.
+    """
+    path = model_folder + 'flat/' + name + '.flat'
+    if not os.path.isfile(path):
+        print('No flat weights for {}. Run convert_weights.py first. Use regular checkpoint'.format(name))
+        return None
+    return path
+
+
+def load_flat_model(path):
+    """
+    Loads model saved by convert_weights.py. Weights are memory mapped, not copied.
+    Bags of models are restored with their weights.
+    """
+    from demucs.apply import BagOfModels
+    from demucs4.states import load_flat
+
+    models, meta = load_flat(path)
+    if meta.get('bag'):
+        return BagOfModels(models, meta['weights'])
+    return models[0]
+
+
+def get_demucs_model(name, model_folder, device, quantized=False, vendored=False, compiled=False, fold_weights=False, mmap_weights=False):
+    """
+    name - either name of pretrained model from demucs repo or DEMUCS_VOCALS_MODEL
+    quantized - use dynamically quantized INT8 version of model if available
+    vendored - use implementation from demucs4 folder (needed for reduced precision and weight folding)
+    compiled - use TorchScript version of model traced at fixed segment length
+    fold_weights - fold LayerScale, norm affine params and embedding scales into weights (needs vendored)
+    mmap_weights - load memory mapped flat weights created by convert_weights.py if available
+    """
+    from demucs.states import load_model
+    from demucs import pretrained
+
+    model = None
+    if quantized:
+        path = get_quantized_path(model_folder, name, '.th')
+        if path is not None:
+            print('Use quantized model: {}'.format(path))
+            model = torch_load(path)
+            vendored = False
+    if model is None and mmap_weights:
+        path = get_flat_path(model_folder, name)
+        if path is not None:
+            print('Use flat weights: {}'.format(path))
+            model = load_flat_model(path)
+    if model is None:
+        if name == DEMUCS_VOCALS_MODEL:
+            model_path = model_folder + name + '.th'
+            if not os.path.isfile(model_path):
+                torch.hub.download_url_to_file(DEMUCS_VOCALS_URL, model_path)
+            model = load_model(model_path)
+        else:
+            model = pretrained.get_model(name)
+    if vendored:
+        model = get_vendored_model(model)
+        if fold_weights:
+            from demucs4.optimize import prepare_for_inference
+            counts = prepare_for_inference(model)
+            print('Folded modules: {}'.format(', '.join('{}: {}'.format(k, v) for k, v in counts.items())))
+    model.to(device)
+    if compiled:
+        model = get_compiled_model(model, device, model_folder)
+    return model
+
+
+@functools.lru_cache(maxsize=None)
+def get_compiled_demucs_class():
+    """
+    Returns CompiledDemucs class. It's defined here, so torch is imported only when it's needed.
+    """
+    class CompiledDemucs(torch.nn.Module):
+        """
+        Runs TorchScript version of Demucs model for inputs with the shape it was traced for
+        and original model for everything else (e.g. last shorter chunk for HDemucs).
+        """
+        def __init__(self, model, traced, shape):
+            super(CompiledDemucs, self).__init__()
+            self.model = model
+            self.traced = traced
+            self.shape = tuple(shape)
+            # attributes used by apply_model
+            self.sources = model.sources
+            self.samplerate = model.samplerate
+            self.segment = model.segment
+            self.audio_channels = model.audio_channels
+            if hasattr(model, 'valid_length'):
+                self.valid_length = model.valid_length
+
+        def forward(self, mix):
+            if tuple(mix.shape) == self.shape:
+                return self.traced(mix)
+            return self.model(mix)
+
+    return CompiledDemucs
+
+
+def get_model_hash(model):
+    hash_sha = hashlib.sha256()
+    for key, value in model.state_dict().items():
+        hash_sha.update(key.encode())
+        values = value if isinstance(value, (tuple, list)) else [value]
+        for v in values:
+            if isinstance(v, torch.Tensor):
+                if v.is_quantized:
+                    v = v.int_repr()
+                hash_sha.update(v.detach().cpu().contiguous().numpy().tobytes())
+            else:
+                hash_sha.update(repr(v).encode())
+    return hash_sha.hexdigest()
+
+
+def time_forward(model, mix, runs=2):
+    with torch.no_grad():
+        model(mix)
+        start_time = time()
+        for _ in range(runs):
+            model(mix)
+    return (time() - start_time) / runs
+
+
+def get_compiled_model(model, device, model_folder):
+    """
+    Returns model which runs TorchScript version of each Demucs model at its fixed segment length.
+    Traced models are cached in models/compiled/ with key from model weights hash, torch version,
+    device and segment shape, so tracing is done only once.
+    """
+    from demucs.apply import BagOfModels
+
+    if isinstance(model, BagOfModels):
+        for i, sub_model in enumerate(model.models):
+            model.models[i] = get_compiled_model(sub_model, device, model_folder)
+        return model
+    model.to(device)
+    model.eval()
+    shape = (1, model.audio_channels, int(model.segment * model.samplerate))
+    key = '{}-torch{}-{}-{}'.format(
+        get_model_hash(model)[:16],
+        torch.__version__,
+        device.split(':')[0],
+        'x'.join([str(s) for s in shape]),
+    )
+    compiled_folder = model_folder + 'compiled/'
+    if not os.path.isdir(compiled_folder):
+        os.mkdir(compiled_folder)
+    path = compiled_folder + key + '.pt'
+    if os.path.isfile(path) and os.path.isfile(path + '.json'):
+        start_time = time()
+        traced = torch.jit.load(path, map_location=device)
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        print('Use compiled model: {} Load time: {:.2f} sec Segment time eager: {:.2f} sec compiled: {:.2f} sec'.format(
+            path, time() - start_time, meta['time_eager'], meta['time_compiled']))
+        return get_compiled_demucs_class()(model, traced, shape)
+
+    print('Compile model for segment shape {}'.format(shape))
+    mix = torch.randn(shape, generator=torch.Generator().manual_seed(0)).to(device)
+    start_time = time()
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, mix, check_trace=False))
+    compile_time = time() - start_time
+    meta = {
+        'torch_version': torch.__version__,
+        'device': device,
+        'shape': shape,
+        'compile_time': compile_time,
+        'time_eager': time_forward(model, mix),
+        'time_compiled': time_forward(traced, mix),
+    }
+    torch.jit.save(traced, path)
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Compiled model: {} Compile time: {:.2f} sec Segment time eager: {:.2f} sec compiled: {:.2f} sec'.format(
+        path, compile_time, meta['time_eager'], meta['time_compiled']))
+    return get_compiled_demucs_class()(model, traced, shape)
+
+
+def apply_demucs(model, audio, shifts, overlap, precision='float32'):
+    """
+    Same as apply_model from demucs, but can run model under autocast with reduced precision.
+    precision - 'float32', 'bfloat16' or 'float16'
+    """
+    from demucs.apply import apply_model
+
+    if precision == 'float32':
+        return apply_model(model, audio, shifts=shifts, overlap=overlap)
+    with torch.autocast(audio.device.type, dtype=getattr(torch, precision)):
+        out = apply_model(model, audio, shifts=shifts, overlap=overlap)
+    return out.float()
+
+
+def get_onnx_session(name, model_folder, providers, quantized=False, threads=0):
+    """
+    name - name of ONNX model from UVR model repo, e.g. 'Kim_Vocal_2'
+    quantized - use INT8 version of model if available
+    threads - number of intra op threads, 0 - onnxruntime default
+    """
+    model_path_onnx = None
+    if quantized:
+        model_path_onnx = get_quantized_path(model_folder, name, '.onnx')
+    if model_path_onnx is None:
+        model_path_onnx = model_folder + name + '.onnx'
+        if not os.path.isfile(model_path_onnx):
+            torch.hub.download_url_to_file(ONNX_MODELS_URL + name + '.onnx', model_path_onnx)
+    print('Model path: {}'.format(model_path_onnx))
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = threads
+    infer_session = ort.InferenceSession(
+        model_path_onnx,
+        sess_options=sess_options,
+        providers=providers,
+        provider_options=[{"device_id": 0}],
+    )
+    return infer_session
+
+
 def demix_base(mix, device, models, infer_session):
     start_time = time()
     sources = []
@@ -145,7 +457,71 @@ def demix_base(mix, device, models, infer_session):
     return np.array(sources)
 
 
-def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75):
+class SeparationCheckpoint:
+    """
+    Intermediate results of separation of one file in work directory. If process dies, rerun with
+    the same work directory resumes from the last finished model or the last saved chunk of demix_full.
+    Folder is named by hash of audio and model settings, it's removed when separation is finished.
+    """
+    def __init__(self, work_dir, audio, settings, interval=60.0):
+        """
+        interval - chunk progress of demix_full is saved not more often than once per interval seconds
+        """
+        key = hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        key.update(np.ascontiguousarray(audio).data)
+        self.folder = os.path.join(work_dir, key.hexdigest())
+        self.interval = interval
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.folder, name + '.npz')
+
+    def load(self, name):
+        """
+        Returns dict of arrays saved with name or None.
+        """
+        if not os.path.isfile(self.get_path(name)):
+            return None
+        with np.load(self.get_path(name)) as data:
+            return {key: data[key] for key in data.files}
+
+    def save(self, name, **arrays):
+        # rename is atomic, so checkpoint is never partially written
+        temp_path = self.get_path(name) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self.get_path(name))
+
+    def remove(self, name):
+        if os.path.isfile(self.get_path(name)):
+            os.remove(self.get_path(name))
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def run_stage(checkpoint, name, func):
+    """
+    Returns result of func(), it's saved in checkpoint and loaded from it at rerun.
+    checkpoint - SeparationCheckpoint or None
+    """
+    if checkpoint is None:
+        return func()
+    data = checkpoint.load(name)
+    if data is not None:
+        print('Resume: {} is loaded from checkpoint'.format(name))
+        return data['result']
+    result = func()
+    checkpoint.save(name, result=result)
+    # progress of chunks of this stage is not needed anymore
+    checkpoint.remove(name + '_chunks')
+    return result
+
+
+def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75, checkpoint=None, name=None):
+    """
+    checkpoint - SeparationCheckpoint to save progress of chunks with given name or None
+    """
     start_time = time()
 
     step = int(chunk_size * (1 - overlap))
@@ -153,8 +529,20 @@ def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75):
     result = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
     divider = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
 
+    first = 0
+    if checkpoint is not None:
+        state = checkpoint.load(name + '_chunks')
+        if state is not None:
+            first = int(state['position'])
+            result[..., :state['result'].shape[-1]] = state['result']
+            # divider depends only on positions of chunks
+            for i in range(0, first, step):
+                divider[..., i:i + chunk_size] += 1
+            print('Resume: {} from sample {} of {}'.format(name, first, mix.shape[-1]))
+    last_save_time = time()
+
     total = 0
-    for i in range(0, mix.shape[-1], step):
+    for i in range(first, mix.shape[-1], step):
         total += 1
 
         start = i
@@ -165,11 +553,118 @@ def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75):
         # print(sources.shape)
         result[..., start:end] += sources
         divider[..., start:end] += 1
+        if checkpoint is not None and i + step < mix.shape[-1] and time() - last_save_time > checkpoint.interval:
+            # samples after the end of this chunk are still zero
+            checkpoint.save(name + '_chunks', result=result[..., :end], position=np.array(i + step))
+            last_save_time = time()
     sources = result / divider
     # print('Final shape: {} Overall time: {:.2f}'.format(sources.shape, time() - start_time))
     return sources
 
 
+def parse_model_options(model, options):
+    """
+    Sets device, overlaps, chunk size, ensemble weights and model loading settings of separation model from user options.
+    model - EnsembleDemucsMDXMusicSeparationModel or EnsembleDemucsMDXMusicSeparationModelLowGPU
+    options - user options
+    """
+    if torch.cuda.is_available():
+        device = 'cuda:0'
+    else:
+        device = 'cpu'
+    if 'cpu' in options:
+        if options['cpu']:
+            device = 'cpu'
+    print('Use device: {}'.format(device))
+    model.device = device
+    model.single_onnx = False
+    if 'single_onnx' in options:
+        if options['single_onnx']:
+            model.single_onnx = True
+            print('Use single vocal ONNX')
+
+    model.kim_model_1 = False
+    if 'use_kim_model_1' in options:
+        if options['use_kim_model_1']:
+            model.kim_model_1 = True
+    if model.kim_model_1:
+        print('Use Kim model 1')
+    else:
+        print('Use Kim model 2')
+
+    model.overlap_large = float(options['overlap_large'])
+    model.overlap_small = float(options['overlap_small'])
+    if model.overlap_large > 0.99:
+        model.overlap_large = 0.99
+    if model.overlap_large < 0.0:
+        model.overlap_large = 0.0
+    if model.overlap_small > 0.99:
+        model.overlap_small = 0.99
+    if model.overlap_small < 0.0:
+        model.overlap_small = 0.0
+
+    model.weights_vocals = np.array([10, 1, 8, 9])
+    model.weights_bass = np.array([19, 4, 5, 8])
+    model.weights_drums = np.array([18, 2, 4, 9])
+    model.weights_other = np.array([14, 2, 5, 10])
+
+    if device == 'cpu':
+        chunk_size = 200000000
+        model.providers = ["CPUExecutionProvider"]
+    else:
+        chunk_size = 1000000
+        model.providers = ["CUDAExecutionProvider"]
+    if 'chunk_size' in options:
+        chunk_size = int(options['chunk_size'])
+    model.chunk_size = chunk_size
+
+    model.quantized = False
+    if 'quantized' in options:
+        if options['quantized']:
+            if device == 'cpu':
+                model.quantized = True
+                print('Use INT8 quantized models')
+            else:
+                print('Quantized models are available only for CPU. Use float models')
+
+    model.precision = 'float32'
+    if 'precision' in options:
+        model.precision = options['precision']
+    if model.precision != 'float32':
+        print('Use {} precision for Demucs models'.format(model.precision))
+
+    model.compiled = False
+    if 'compile' in options:
+        if options['compile']:
+            if model.precision == 'float32':
+                model.compiled = True
+                print('Use compiled Demucs models')
+            else:
+                print('Compiled models are available only for float32 precision. Use eager models')
+
+    model.fold_weights = False
+    if 'fold_weights' in options:
+        if options['fold_weights']:
+            model.fold_weights = True
+            print('Fold constant scales into Demucs weights')
+    model.mmap_weights = False
+    if 'mmap_weights' in options:
+        if options['mmap_weights']:
+            model.mmap_weights = True
+            print('Use memory mapped flat weights for Demucs models')
+    model.vendored = model.precision != 'float32' or model.fold_weights
+    if model.vendored or model.mmap_weights:
+        # validation asserts of vendored models are not needed for inference
+        from demucs4.utils import set_fast_inference
+        set_fast_inference(True)
+
+    model.work_dir = None
+    if 'work_dir' in options:
+        if options['work_dir'] is not None:
+            model.work_dir = options['work_dir']
+            print('Save checkpoints of separation to: {}'.format(model.work_dir))
+
+
 class EnsembleDemucsMDXMusicSeparationModel:
     def __init__(self, options):
         """
@@ -177,70 +672,17 @@ class EnsembleDemucsMDXMusicSeparationModel:
         """
         # print(options)
 
-        if torch.cuda.is_available():
-            device = 'cuda:0'
-        else:
-            device = 'cpu'
-        if 'cpu' in options:
-            if options['cpu']:
-                device = 'cpu'
-        print('Use device: {}'.format(device))
-        self.single_onnx = False
-        if 'single_onnx' in options:
-            if options['single_onnx']:
-                self.single_onnx = True
-                print('Use single vocal ONNX')
-
-        self.kim_model_1 = False
-        if 'use_kim_model_1' in options:
-            if options['use_kim_model_1']:
-                self.kim_model_1 = True
-        if self.kim_model_1:
-            print('Use Kim model 1')
-        else:
-            print('Use Kim model 2')
-
-        self.overlap_large = float(options['overlap_large'])
-        self.overlap_small = float(options['overlap_small'])
-        if self.overlap_large > 0.99:
-            self.overlap_large = 0.99
-        if self.overlap_large < 0.0:
-            self.overlap_large = 0.0
-        if self.overlap_small > 0.99:
-            self.overlap_small = 0.99
-        if self.overlap_small < 0.0:
-            self.overlap_small = 0.0
-
-        model_folder = os.path.dirname(os.path.realpath(__file__)) + '/models/'
-        remote_url = 'https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th'
-        model_path = model_folder + '04573f0d-f3cf25b2.th'
-        if not os.path.isfile(model_path):
-            torch.hub.download_url_to_file(remote_url, model_folder + '04573f0d-f3cf25b2.th')
-        model_vocals = load_model(model_path)
-        model_vocals.to(device)
-        self.model_vocals_only = model_vocals
+        parse_model_options(self, options)
+        device = self.device
+        chunk_size = self.chunk_size
 
-        self.models = []
-        self.weights_vocals = np.array([10, 1, 8, 9])
-        self.weights_bass = np.array([19, 4, 5, 8])
-        self.weights_drums = np.array([18, 2, 4, 9])
-        self.weights_other = np.array([14, 2, 5, 10])
+        model_folder = get_model_folder()
+        self.model_vocals_only = get_demucs_model(DEMUCS_VOCALS_MODEL, model_folder, device, self.quantized, self.vendored, self.compiled, self.fold_weights, self.mmap_weights)
 
-        model1 = pretrained.get_model('htdemucs_ft')
-        model1.to(device)
-        self.models.append(model1)
-
-        model2 = pretrained.get_model('htdemucs')
-        model2.to(device)
-        self.models.append(model2)
-
-        model3 = pretrained.get_model('htdemucs_6s')
-        model3.to(device)
-        self.models.append(model3)
+        self.models = []
 
-        model4 = pretrained.get_model('hdemucs_mmi')
-        model4.to(device)
-        self.models.append(model4)
+        for name in ['htdemucs_ft', 'htdemucs', 'htdemucs_6s', 'hdemucs_mmi']:
+            self.models.append(get_demucs_model(name, model_folder, device, self.quantized, self.vendored, self.compiled, self.fold_weights, self.mmap_weights))
 
         if 0:
             for model in self.models:
@@ -252,53 +694,34 @@ class EnsembleDemucsMDXMusicSeparationModel:
         ['drums', 'bass', 'other', 'vocals']
         '''
 
-        if device == 'cpu':
-            chunk_size = 200000000
-            providers = ["CPUExecutionProvider"]
-        else:
-            chunk_size = 1000000
-            providers = ["CUDAExecutionProvider"]
-        if 'chunk_size' in options:
-            chunk_size = int(options['chunk_size'])
-
         # MDX-B model 1 initialization
-        self.chunk_size = chunk_size
         self.mdx_models1 = get_models('tdf_extra', load=False, device=device, vocals_model_type=2)
         if self.kim_model_1:
-            model_path_onnx1 = model_folder + 'Kim_Vocal_1.onnx'
-            remote_url_onnx1 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_1.onnx'
+            self.name_onnx1 = 'Kim_Vocal_1'
         else:
-            model_path_onnx1 = model_folder + 'Kim_Vocal_2.onnx'
-            remote_url_onnx1 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_2.onnx'
-        if not os.path.isfile(model_path_onnx1):
-            torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-        print('Model path: {}'.format(model_path_onnx1))
-        print('Device: {} Chunk size: {}'.format(device, chunk_size))
-        self.infer_session1 = ort.InferenceSession(
-            model_path_onnx1,
-            providers=providers,
-            provider_options=[{"device_id": 0}],
-        )
+            self.name_onnx1 = 'Kim_Vocal_2'
 
         if self.single_onnx is False:
             # MDX-B model 2  initialization
-            self.chunk_size = chunk_size
             self.mdx_models2 = get_models('tdf_extra', load=False, device=device, vocals_model_type=2)
-            root_path = os.path.dirname(os.path.realpath(__file__)) + '/'
-            model_path_onnx2 = model_folder + 'Kim_Inst.onnx'
-            remote_url_onnx2 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Inst.onnx'
-            if not os.path.isfile(model_path_onnx2):
-                torch.hub.download_url_to_file(remote_url_onnx2, model_path_onnx2)
-            print('Model path: {}'.format(model_path_onnx2))
-            print('Device: {} Chunk size: {}'.format(device, chunk_size))
-            self.infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
-            )
 
-        self.device = device
+        self.model_folder = model_folder
+        self.create_onnx_sessions()
+        print('Device: {} Chunk size: {}'.format(device, chunk_size))
         pass
+
+    def create_onnx_sessions(self, threads=0):
+        """
+        ONNX sessions are not fork safe, so worker processes create their own sessions.
+        threads - number of intra op threads, 0 - onnxruntime default
+        """
+        self.infer_session1 = get_onnx_session(self.name_onnx1, self.model_folder, self.providers, self.quantized, threads)
+        if self.single_onnx is False:
+            self.infer_session2 = get_onnx_session('Kim_Inst', self.model_folder, self.providers, self.quantized, threads)
+
+    def close_onnx_sessions(self):
+        self.infer_session1 = None
+        self.infer_session2 = None
         
     @property
     def instruments(self):
@@ -308,6 +731,16 @@ class EnsembleDemucsMDXMusicSeparationModel:
     def raise_aicrowd_error(self, msg):
         """ Will be used by the evaluator to provide logs, DO NOT CHANGE """
         raise NameError(msg)
+
+    def get_checkpoint(self, mixed_sound_array):
+        """
+        Returns SeparationCheckpoint for audio if work directory is set, otherwise None.
+        """
+        if self.work_dir is None:
+            return None
+        settings = [type(self).__name__, self.overlap_large, self.overlap_small, self.chunk_size, self.single_onnx,
+                    self.kim_model_1, self.quantized, self.precision, self.compiled, self.fold_weights]
+        return SeparationCheckpoint(self.work_dir, mixed_sound_array, settings)
     
     def separate_music_file(
             self,
@@ -339,32 +772,40 @@ class EnsembleDemucsMDXMusicSeparationModel:
 
         overlap_large = self.overlap_large
         overlap_small = self.overlap_small
+        checkpoint = self.get_checkpoint(mixed_sound_array)
 
         # Get Demics vocal only
         model = self.model_vocals_only
         shifts = 1
         overlap = overlap_large
-        vocals_demucs = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
+        def get_vocals_demucs():
+            vocals_demucs = 0.5 * apply_demucs(model, audio, shifts, overlap, self.precision)[0][3].cpu().numpy()
+
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.10) / total_files
+                update_percent_func(int(val))
 
-        vocals_demucs += 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
+            vocals_demucs += 0.5 * -apply_demucs(model, -audio, shifts, overlap, self.precision)[0][3].cpu().numpy()
+            return vocals_demucs
+
+        vocals_demucs = run_stage(checkpoint, 'vocals_demucs', get_vocals_demucs)
 
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.20) / total_files
             update_percent_func(int(val))
 
         overlap = overlap_large
-        sources1 = demix_full(
+        sources1 = run_stage(checkpoint, 'vocals_mdxb1', lambda: demix_full(
             mixed_sound_array.T,
             self.device,
             self.chunk_size,
             self.mdx_models1,
             self.infer_session1,
-            overlap=overlap
-        )[0]
+            overlap=overlap,
+            checkpoint=checkpoint,
+            name='vocals_mdxb1',
+        )[0])
 
         vocals_mdxb1 = sources1
 
@@ -373,14 +814,16 @@ class EnsembleDemucsMDXMusicSeparationModel:
             update_percent_func(int(val))
 
         if self.single_onnx is False:
-            sources2 = -demix_full(
+            sources2 = -run_stage(checkpoint, 'instrum_mdxb2', lambda: demix_full(
                 -mixed_sound_array.T,
                 self.device,
                 self.chunk_size,
                 self.mdx_models2,
                 self.infer_session2,
-                overlap=overlap
-            )[0]
+                overlap=overlap,
+                checkpoint=checkpoint,
+                name='instrum_mdxb2',
+            )[0])
 
             # it's instrumental so need to invert
             instrum_mdxb2 = sources2
@@ -409,14 +852,25 @@ class EnsembleDemucsMDXMusicSeparationModel:
             audio = np.expand_dims(instrum.T, axis=0)
             audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
 
-            all_outs = []
+            # weighted sum of outputs is saved after each model
+            out_sum = None
+            done = 0
+            if checkpoint is not None:
+                state = checkpoint.load('demucs_sum')
+                if state is not None:
+                    # vocals of Demucs ensemble are not used, so they are not saved
+                    out_sum, done = state['result'], int(state['models'])
+                    out_sum = np.concatenate([out_sum, np.zeros_like(out_sum[:1])])
+                    print('Resume: outputs of {} Demucs models are loaded from checkpoint'.format(done))
             for i, model in enumerate(self.models):
+                if i < done:
+                    continue
                 if i == 0:
                     overlap = overlap_small
                 elif i > 0:
                     overlap = overlap_large
-                out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-                      + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
+                out = 0.5 * apply_demucs(model, audio, shifts, overlap, self.precision)[0].cpu().numpy() \
+                      + 0.5 * -apply_demucs(model, -audio, shifts, overlap, self.precision)[0].cpu().numpy()
 
                 if update_percent_func is not None:
                     val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
@@ -432,8 +886,13 @@ class EnsembleDemucsMDXMusicSeparationModel:
                 out[2] = self.weights_other[i] * out[2]
                 out[3] = self.weights_vocals[i] * out[3]
 
-                all_outs.append(out)
-            out = np.array(all_outs).sum(axis=0)
+                if out_sum is None:
+                    out_sum = out
+                else:
+                    out_sum = out_sum + out
+                if checkpoint is not None and i + 1 < len(self.models):
+                    checkpoint.save('demucs_sum', result=out_sum[:3], models=np.array(i + 1))
+            out = out_sum
             out[0] = out[0] / self.weights_drums.sum()
             out[1] = out[1] / self.weights_bass.sum()
             out[2] = out[2] / self.weights_other.sum()
@@ -469,6 +928,8 @@ class EnsembleDemucsMDXMusicSeparationModel:
             val = 100 * (current_file_number + 0.95) / total_files
             update_percent_func(int(val))
 
+        if checkpoint is not None:
+            checkpoint.clear()
         return separated_music_arrays, output_sample_rates
 
 
@@ -479,55 +940,7 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         """
         # print(options)
 
-        if torch.cuda.is_available():
-            device = 'cuda:0'
-        else:
-            device = 'cpu'
-        if 'cpu' in options:
-            if options['cpu']:
-                device = 'cpu'
-        print('Use device: {}'.format(device))
-        self.single_onnx = False
-        if 'single_onnx' in options:
-            if options['single_onnx']:
-                self.single_onnx = True
-                print('Use single vocal ONNX')
-
-        self.kim_model_1 = False
-        if 'use_kim_model_1' in options:
-            if options['use_kim_model_1']:
-                self.kim_model_1 = True
-        if self.kim_model_1:
-            print('Use Kim model 1')
-        else:
-            print('Use Kim model 2')
-
-        self.overlap_large = float(options['overlap_large'])
-        self.overlap_small = float(options['overlap_small'])
-        if self.overlap_large > 0.99:
-            self.overlap_large = 0.99
-        if self.overlap_large < 0.0:
-            self.overlap_large = 0.0
-        if self.overlap_small > 0.99:
-            self.overlap_small = 0.99
-        if self.overlap_small < 0.0:
-            self.overlap_small = 0.0
-
-        self.weights_vocals = np.array([10, 1, 8, 9])
-        self.weights_bass = np.array([19, 4, 5, 8])
-        self.weights_drums = np.array([18, 2, 4, 9])
-        self.weights_other = np.array([14, 2, 5, 10])
-
-        if device == 'cpu':
-            chunk_size = 200000000
-            self.providers = ["CPUExecutionProvider"]
-        else:
-            chunk_size = 1000000
-            self.providers = ["CUDAExecutionProvider"]
-        if 'chunk_size' in options:
-            chunk_size = int(options['chunk_size'])
-        self.chunk_size = chunk_size
-        self.device = device
+        parse_model_options(self, options)
         pass
 
     @property
@@ -539,6 +952,16 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         """ Will be used by the evaluator to provide logs, DO NOT CHANGE """
         raise NameError(msg)
 
+    def get_checkpoint(self, mixed_sound_array):
+        """
+        Returns SeparationCheckpoint for audio if work directory is set, otherwise None.
+        """
+        if self.work_dir is None:
+            return None
+        settings = [type(self).__name__, self.overlap_large, self.overlap_small, self.chunk_size, self.single_onnx,
+                    self.kim_model_1, self.quantized, self.precision, self.compiled, self.fold_weights]
+        return SeparationCheckpoint(self.work_dir, mixed_sound_array, settings)
+
     def separate_music_file(
             self,
             mixed_sound_array,
@@ -570,95 +993,85 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         overlap_large = self.overlap_large
         overlap_small = self.overlap_small
 
+        checkpoint = self.get_checkpoint(mixed_sound_array)
+
         # Get Demucs vocal only
-        model_folder = os.path.dirname(os.path.realpath(__file__)) + '/models/'
-        remote_url = 'https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th'
-        model_path = model_folder + '04573f0d-f3cf25b2.th'
-        if not os.path.isfile(model_path):
-            torch.hub.download_url_to_file(remote_url, model_folder + '04573f0d-f3cf25b2.th')
-        model_vocals = load_model(model_path)
-        model_vocals.to(self.device)
+        model_folder = get_model_folder()
         shifts = 1
         overlap = overlap_large
-        vocals_demucs = 0.5 * apply_model(model_vocals, audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
+        def get_vocals_demucs():
+            model_vocals = get_demucs_model(DEMUCS_VOCALS_MODEL, model_folder, self.device, self.quantized, self.vendored, self.compiled, self.fold_weights, self.mmap_weights)
+            vocals_demucs = 0.5 * apply_demucs(model_vocals, audio, shifts, overlap, self.precision)[0][3].cpu().numpy()
+
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.10) / total_files
+                update_percent_func(int(val))
 
-        vocals_demucs += 0.5 * -apply_model(model_vocals, -audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
-        model_vocals = model_vocals.cpu()
-        del model_vocals
+            vocals_demucs += 0.5 * -apply_demucs(model_vocals, -audio, shifts, overlap, self.precision)[0][3].cpu().numpy()
+            model_vocals = model_vocals.cpu()
+            del model_vocals
+            return vocals_demucs
+
+        vocals_demucs = run_stage(checkpoint, 'vocals_demucs', get_vocals_demucs)
 
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.20) / total_files
             update_percent_func(int(val))
 
-        # MDX-B model 1 initialization
-        mdx_models1 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
-        if self.kim_model_1:
-            model_path_onnx1 = model_folder + 'Kim_Vocal_1.onnx'
-            remote_url_onnx1 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_1.onnx'
-        else:
-            model_path_onnx1 = model_folder + 'Kim_Vocal_2.onnx'
-            remote_url_onnx1 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_2.onnx'
-        if not os.path.isfile(model_path_onnx1):
-            torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-        print('Model path: {}'.format(model_path_onnx1))
-        print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
-        infer_session1 = ort.InferenceSession(
-            model_path_onnx1,
-            providers=self.providers,
-            provider_options=[{"device_id": 0}],
-        )
-        overlap = overlap_large
-        sources1 = demix_full(
-            mixed_sound_array.T,
-            self.device,
-            self.chunk_size,
-            mdx_models1,
-            infer_session1,
-            overlap=overlap
-        )[0]
-        vocals_mdxb1 = sources1
-        del infer_session1
-        del mdx_models1
+        def get_vocals_mdxb1():
+            # MDX-B model 1 initialization
+            mdx_models1 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
+            if self.kim_model_1:
+                name_onnx1 = 'Kim_Vocal_1'
+            else:
+                name_onnx1 = 'Kim_Vocal_2'
+            infer_session1 = get_onnx_session(name_onnx1, model_folder, self.providers, self.quantized)
+            print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
+            sources1 = demix_full(
+                mixed_sound_array.T,
+                self.device,
+                self.chunk_size,
+                mdx_models1,
+                infer_session1,
+                overlap=overlap_large,
+                checkpoint=checkpoint,
+                name='vocals_mdxb1',
+            )[0]
+            del infer_session1
+            del mdx_models1
+            return sources1
+
+        vocals_mdxb1 = run_stage(checkpoint, 'vocals_mdxb1', get_vocals_mdxb1)
 
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.30) / total_files
             update_percent_func(int(val))
 
         if self.single_onnx is False:
-            # MDX-B model 2  initialization
-            mdx_models2 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
-            root_path = os.path.dirname(os.path.realpath(__file__)) + '/'
-            model_path_onnx2 = model_folder + 'Kim_Inst.onnx'
-            remote_url_onnx2 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Inst.onnx'
-            if not os.path.isfile(model_path_onnx2):
-                torch.hub.download_url_to_file(remote_url_onnx2, model_path_onnx2)
-            print('Model path: {}'.format(model_path_onnx2))
-            print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
-            infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=self.providers,
-                provider_options=[{"device_id": 0}],
-            )
-
-            overlap = overlap_large
-            sources2 = -demix_full(
-                -mixed_sound_array.T,
-                self.device,
-                self.chunk_size,
-                mdx_models2,
-                infer_session2,
-                overlap=overlap
-            )[0]
+            def get_instrum_mdxb2():
+                # MDX-B model 2  initialization
+                mdx_models2 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
+                infer_session2 = get_onnx_session('Kim_Inst', model_folder, self.providers, self.quantized)
+                print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
+
+                sources2 = demix_full(
+                    -mixed_sound_array.T,
+                    self.device,
+                    self.chunk_size,
+                    mdx_models2,
+                    infer_session2,
+                    overlap=overlap_large,
+                    checkpoint=checkpoint,
+                    name='instrum_mdxb2',
+                )[0]
+                del infer_session2
+                del mdx_models2
+                return sources2
 
             # it's instrumental so need to invert
-            instrum_mdxb2 = sources2
+            instrum_mdxb2 = -run_stage(checkpoint, 'instrum_mdxb2', get_instrum_mdxb2)
             vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
-            del infer_session2
-            del mdx_models2
 
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.40) / total_files
@@ -678,87 +1091,50 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         audio = np.expand_dims(instrum.T, axis=0)
         audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
 
-        all_outs = []
-
-        i = 0
-        overlap = overlap_small
-        model = pretrained.get_model('htdemucs_ft')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 1
-        overlap = overlap_large
-        model = pretrained.get_model('htdemucs')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 2
-        overlap = overlap_large
-        model = pretrained.get_model('htdemucs_6s')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        # More stems need to add
-        out[2] = out[2] + out[4] + out[5]
-        out = out[:4]
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 3
-        model = pretrained.get_model('hdemucs_mmi')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        out = np.array(all_outs).sum(axis=0)
+        # models are loaded one by one, weighted sum of outputs is saved after each model
+        out_sum = None
+        done = 0
+        if checkpoint is not None:
+            state = checkpoint.load('demucs_sum')
+            if state is not None:
+                # vocals of Demucs ensemble are not used, so they are not saved
+                out_sum, done = state['result'], int(state['models'])
+                out_sum = np.concatenate([out_sum, np.zeros_like(out_sum[:1])])
+                print('Resume: outputs of {} Demucs models are loaded from checkpoint'.format(done))
+        names = ['htdemucs_ft', 'htdemucs', 'htdemucs_6s', 'hdemucs_mmi']
+        for i, name in enumerate(names):
+            if i < done:
+                continue
+            if i == 0:
+                overlap = overlap_small
+            else:
+                overlap = overlap_large
+            model = get_demucs_model(name, model_folder, self.device, self.quantized, self.vendored, self.compiled, self.fold_weights, self.mmap_weights)
+            out = 0.5 * apply_demucs(model, audio, shifts, overlap, self.precision)[0].cpu().numpy() \
+                  + 0.5 * -apply_demucs(model, -audio, shifts, overlap, self.precision)[0].cpu().numpy()
+
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
+                update_percent_func(int(val))
+
+            if i == 2:
+                # More stems need to add
+                out[2] = out[2] + out[4] + out[5]
+                out = out[:4]
+            out[0] = self.weights_drums[i] * out[0]
+            out[1] = self.weights_bass[i] * out[1]
+            out[2] = self.weights_other[i] * out[2]
+            out[3] = self.weights_vocals[i] * out[3]
+            if out_sum is None:
+                out_sum = out
+            else:
+                out_sum = out_sum + out
+            if checkpoint is not None and i + 1 < len(names):
+                checkpoint.save('demucs_sum', result=out_sum[:3], models=np.array(i + 1))
+            model = model.cpu()
+            del model
+
+        out = out_sum
         out[0] = out[0] / self.weights_drums.sum()
         out[1] = out[1] / self.weights_bass.sum()
         out[2] = out[2] / self.weights_other.sum()
@@ -798,24 +1174,1172 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
             val = 100 * (current_file_number + 0.95) / total_files
             update_percent_func(int(val))
 
+        if checkpoint is not None:
+            checkpoint.clear()
         return separated_music_arrays, output_sample_rates
 
 
-def predict_with_model(options):
-    for input_audio in options['input_audio']:
-        if not os.path.isfile(input_audio):
-            print('Error. No such file: {}. Please check path!'.format(input_audio))
-            return
-    output_folder = options['output_folder']
-    if not os.path.isdir(output_folder):
-        os.mkdir(output_folder)
-
+def read_audio(path):
+    """
+    Returns stereo audio (channels, samples) resampled to 44100 and sample rate.
+    """
+    audio, sr = librosa.load(path, mono=False, sr=44100)
+    if len(audio.shape) == 1:
+        audio = np.stack([audio, audio], axis=0)
+    return audio, sr
+
+
+def probe_audio(path):
+    """
+    Reads duration, sample rate and number of channels from header of audio file without decoding it.
+    Returns dict, sample rate and channels are None if only duration is known.
+    """
+    try:
+        info = sf.info(path)
+        return {'duration': info.duration, 'sr': info.samplerate, 'channels': info.channels}
+    except Exception as e:
+        error = e
+    # formats which libsndfile can't open (e.g. m4a) are decoded by librosa with audioread
+    try:
+        return {'duration': librosa.get_duration(path=path), 'sr': None, 'channels': None}
+    except Exception:
+        raise error
+
+
+def probe_inputs(jobs):
+    """
+    Probes input files of all jobs before processing. Unreadable files are reported and skipped,
+    so they don't stop batch in the middle.
+    Returns list of jobs with readable files and list of their probes.
+    """
+    readable = []
+    probes = []
+    for job in jobs:
+        path = job['input_audio']
+        if not os.path.isfile(path):
+            print('Error. No such file: {}. Please check path! Skip it'.format(path))
+            continue
+        try:
+            probe = probe_audio(path)
+        except Exception as e:
+            print('Error. Can\'t read audio file: {}. Skip it. Reason: {}'.format(path, e))
+            continue
+        readable.append(job)
+        probes.append(probe)
+    return readable, probes
+
+
+def get_makespan(durations, order, workers):
+    """
+    Simulates workers, each of them takes next job in order as soon as it is free.
+    Returns time when the last worker finishes, in units of durations.
+    """
+    loads = [0.0] * workers
+    for index in order:
+        loads[int(np.argmin(loads))] += durations[index]
+    return max(loads)
+
+
+def schedule_jobs(durations, workers):
+    """
+    Longest processing time first: separation time is proportional to duration, and with
+    the longest files started first one long file doesn't end up alone at the end of batch.
+    Returns order of jobs.
+    """
+    order = sorted(range(len(durations)), key=lambda index: -durations[index])
+    print('Jobs: {} Audio: {:.1f} sec Workers: {} Estimated makespan: {:.1f} sec of audio '
+          '(in given order: {:.1f}, lower bound: {:.1f})'.format(
+              len(durations), sum(durations), workers, get_makespan(durations, order, workers),
+              get_makespan(durations, range(len(durations)), workers), max(sum(durations) / workers, max(durations))))
+    return order
+
+
+def read_manifest(path):
+    """
+    Reads JSON lines manifest: one object per line with required key input_audio and optional keys
+    id, output_folder, output_name and only_vocals. Empty lines are skipped.
+    """
+    items = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise ValueError('Manifest {} line {}: {}'.format(path, number, e))
+            if not isinstance(item, dict) or 'input_audio' not in item:
+                raise ValueError('Manifest {} line {}: no input_audio'.format(path, number))
+            items.append(item)
+    return items
+
+
+def get_encoding(options, item=None):
+    """
+    Returns encoding of output files: dict with format (wav, flac or npy), subtype (FLOAT, PCM_16 or PCM_24),
+    dither (tpdf or none) and compression (FLAC compression level 0-8).
+    item - manifest item, it can override output_format and output_subtype of options
+    """
+    encoding = {'format': 'wav', 'subtype': None, 'dither': 'tpdf', 'compression': 5}
+    for key, name in [('format', 'output_format'), ('subtype', 'output_subtype'), ('dither', 'dither'), ('compression', 'flac_compression')]:
+        if name in options and options[name] is not None:
+            encoding[key] = options[name]
+        if item is not None and name in item:
+            encoding[key] = item[name]
+    if encoding['format'] not in ('wav', 'flac', 'npy'):
+        raise ValueError('Unknown output format: {}'.format(encoding['format']))
+    if encoding['subtype'] is None:
+        encoding['subtype'] = 'PCM_24' if encoding['format'] == 'flac' else 'FLOAT'
+    if encoding['subtype'] not in ('FLOAT', 'PCM_16', 'PCM_24'):
+        raise ValueError('Unknown output subtype: {}'.format(encoding['subtype']))
+    if encoding['format'] == 'flac' and encoding['subtype'] == 'FLOAT':
+        raise ValueError('FLAC supports only PCM_16 and PCM_24 subtypes')
+    if not 0 <= int(encoding['compression']) <= 8:
+        raise ValueError('FLAC compression level must be from 0 to 8')
+    return encoding
+
+
+def get_jobs(options):
+    """
+    Returns list of jobs, dicts with id, input_audio, output_folder, output_name, only_vocals and encoding.
+    Jobs are read from manifest if it's given, otherwise from input_audio. Keys missing
+    in manifest items are taken from options. id is input path by default.
+    """
+    output_folder = None
+    if 'output_folder' in options:
+        output_folder = options['output_folder']
     only_vocals = False
     if 'only_vocals' in options:
-        if options['only_vocals'] is True:
-            print('Generate only vocals and instrumental')
-            only_vocals = True
+        only_vocals = options['only_vocals'] is True
+    if 'manifest' in options and options['manifest'] is not None:
+        items = read_manifest(options['manifest'])
+    else:
+        items = [{'input_audio': path} for path in options['input_audio']]
+
+    jobs = []
+    for item in items:
+        job = {
+            'id': str(item.get('id', item['input_audio'])),
+            'input_audio': item['input_audio'],
+            'output_folder': item.get('output_folder', output_folder),
+            'output_name': item.get('output_name', os.path.splitext(os.path.basename(item['input_audio']))[0]),
+            'only_vocals': bool(item.get('only_vocals', only_vocals)),
+            'encoding': get_encoding(options, item),
+        }
+        if job['output_folder'] is None:
+            raise ValueError('No output folder for {}'.format(job['input_audio']))
+        jobs.append(job)
+    return jobs
+
+
+def parse_partition(partition):
+    """
+    partition - string 'i/n', where 0 <= i < n
+    Returns (i, n).
+    """
+    try:
+        index, count = [int(value) for value in partition.split('/')]
+    except ValueError:
+        raise ValueError('Partition must be i/n, got: {}'.format(partition))
+    if not 0 <= index < count:
+        raise ValueError('Partition must be i/n with 0 <= i < n, got: {}'.format(partition))
+    return index, count
+
+
+def get_partition(jobs, index, count):
+    """
+    Keeps jobs of partition `index` out of `count`. Partition of job depends only on hash of its id,
+    not on order of jobs, machine or Python hash seed, so all machines split the same manifest the same way.
+    """
+    return [job for job in jobs if int(hashlib.md5(job['id'].encode('utf-8')).hexdigest(), 16) % count == index]
+
+
+def get_completion_logs(options, partition):
+    """
+    Returns path of completion log to append to (None if there is no log) and list of logs with finished jobs.
+    By default log is written next to manifest, one per partition, so partitions on different
+    machines don't append to the same file, and finished jobs are read from logs of all partitions.
+    """
+    if 'completion_log' in options and options['completion_log'] is not None:
+        return options['completion_log'], [options['completion_log']]
+    if 'manifest' not in options or options['manifest'] is None:
+        return None, []
+    base = os.path.splitext(options['manifest'])[0] + '.done'
+    path = base + '.jsonl'
+    if partition is not None:
+        path = base + '.{}of{}.jsonl'.format(*partition)
+    return path, sorted(set(glob.glob(glob.escape(base) + '*.jsonl') + [path]))
+
+
+def read_completed(paths):
+    """
+    Returns set of ids of finished jobs from completion logs.
+    """
+    completed = set()
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    completed.add(json.loads(line)['id'])
+                except (ValueError, KeyError, TypeError):
+                    # last line is cut if process was killed while writing it
+                    pass
+    return completed
+
+
+def open_completion_log(path):
+    log = open(path, 'a+')
+    log.seek(0, os.SEEK_END)
+    if log.tell() > 0:
+        log.seek(log.tell() - 1)
+        if log.read(1) != '\n':
+            log.write('\n')
+    return log
+
+
+def log_completion(log, job, outputs, duration, elapsed):
+    """
+    Appends record of finished job to completion log and flushes it to disk, so it survives crash of process.
+    """
+    if log is None:
+        return
+    record = {'id': job['id'], 'input_audio': job['input_audio'], 'outputs': outputs,
+              'duration': round(duration, 3), 'time': round(elapsed, 3)}
+    log.write(json.dumps(record) + '\n')
+    log.flush()
+    os.fsync(log.fileno())
+
+
+def get_stems(audio, sr, result, sample_rates, instruments, only_vocals):
+    """
+    Returns list of (stem, data, sample rate) with separated instruments and instrumentals.
+    audio - input audio (channels, samples)
+    """
+    stems = []
+    for instrum in instruments:
+        stems.append((instrum, result[instrum], sample_rates[instrum]))
+
+    # instrumental part 1
+    inst = audio.T - result['vocals']
+    stems.append(('instrum', inst, sr))
+
+    if not only_vocals:
+        # instrumental part 2
+        inst2 = result['bass'] + result['drums'] + result['other']
+        stems.append(('instrum2', inst2, sr))
+    return stems
+
+
+def get_outputs(job, audio, sr, result, sample_rates, instruments):
+    """
+    Returns list of (path, data, sample rate, encoding) with all outputs for one input file.
+    For npy format it's a single container, its data is list of (stem, data, sample rate).
+    """
+    output_folder = job['output_folder']
+    name = job['output_name']
+    encoding = job['encoding']
+    stems = get_stems(audio, sr, result, sample_rates, instruments, job['only_vocals'])
+
+    if encoding['format'] == 'npy':
+        return [(output_folder + '/' + name + '_stems.npy', stems, sr, encoding)]
+    extension = '.' + encoding['format']
+    return [(output_folder + '/' + name + '_{}'.format(stem) + extension, data, stem_sr, encoding) for stem, data, stem_sr in stems]
+
+
+def quantize_audio(data, bits, dither, seed, block=2 ** 20):
+    """
+    Converts float audio in [-1, 1] to integers as soundfile expects them: int16 for 16 bits,
+    int32 with empty low byte for 24 bits. It's done in blocks of samples in float64,
+    so precision is enough for 24 bits and memory doesn't grow with length of file.
+    dither - 'tpdf' adds triangular noise of +-1 LSB before rounding, so quantization error
+    doesn't depend on signal, 'none' - plain rounding
+    """
+    scale = 2 ** (bits - 1)
+    out = np.empty(data.shape, dtype=np.int16 if bits == 16 else np.int32)
+    rng = np.random.default_rng(seed)
+    for start in range(0, data.shape[0], block):
+        part = data[start:start + block].astype(np.float64) * scale
+        if dither == 'tpdf':
+            part += rng.random(part.shape) - rng.random(part.shape)
+        part = np.clip(np.round(part), -scale, scale - 1)
+        if bits == 16:
+            out[start:start + block] = part
+        else:
+            out[start:start + block] = part.astype(np.int32) << (32 - bits)
+    return out
+
+
+def get_stems_sidecar(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def write_stems(path, stems, sr, encoding):
+    """
+    Writes all stems of a track into one .npy array [stems, channels, samples] and JSON sidecar
+    with names of stems, sample rate and scale of integer samples. Each stem is contiguous in time,
+    so a time slice of any stem is read from memory map without reading the rest of the file.
+    Returns size of both files in bytes.
+    """
+    names = [stem for stem, _, _ in stems]
+    if any(stem_sr != sr for _, _, stem_sr in stems):
+        raise ValueError('All stems in container must have the same sample rate')
+    samples, channels = stems[0][1].shape
+    dtype, scale = {'FLOAT': (np.float32, 1), 'PCM_16': (np.int16, 2 ** 15), 'PCM_24': (np.int32, 2 ** 31)}[encoding['subtype']]
+
+    temp_path = path + '.tmp'
+    container = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(len(names), channels, samples))
+    for index, (stem, data, _) in enumerate(stems):
+        if encoding['subtype'] != 'FLOAT':
+            seed = int(hashlib.md5('{}:{}'.format(os.path.basename(path), stem).encode('utf-8')).hexdigest()[:8], 16)
+            data = quantize_audio(data, int(encoding['subtype'][4:]), encoding['dither'], seed)
+        container[index] = data.T
+    container.flush()
+    header_bytes = container.offset
+    del container
+    os.replace(temp_path, path)
+
+    sidecar = {
+        'stems': names,
+        'sample_rate': sr,
+        'channels': channels,
+        'samples': samples,
+        'shape': [len(names), channels, samples],
+        'dtype': np.dtype(dtype).name,
+        # float value of sample is integer value / scale
+        'scale': scale,
+        'header_bytes': header_bytes,
+    }
+    write_json_atomic(get_stems_sidecar(path), sidecar)
+    return os.path.getsize(path) + os.path.getsize(get_stems_sidecar(path))
+
+
+def read_stems(path, stems=None, start=0.0, end=None):
+    """
+    Reads time slice of stems from container written with --output_format npy. Only the slice is read
+    from disk, file is memory mapped.
+    path - path to .npy container
+    stems - list of stem names, None - all stems
+    start, end - time in seconds, end None - till the end of track
+    Returns float32 array [stems, channels, samples] and sidecar dict.
+    """
+    with open(get_stems_sidecar(path)) as f:
+        sidecar = json.load(f)
+    container = np.load(path, mmap_mode='r')
+    indexes = list(range(len(sidecar['stems'])))
+    if stems is not None:
+        indexes = [sidecar['stems'].index(stem) for stem in stems]
+    first = int(round(start * sidecar['sample_rate']))
+    last = None if end is None else int(round(end * sidecar['sample_rate']))
+    data = np.stack([container[index, :, first:last] for index in indexes]).astype(np.float32)
+    if sidecar['scale'] != 1:
+        data /= sidecar['scale']
+    return data, sidecar
+
+
+def write_audio(path, data, sr, encoding=None):
+    """
+    Writes audio file, format is defined by extension of path. For npy format data is list of stems,
+    see write_stems.
+    encoding - see get_encoding, None - 32-bit float
+    Returns size of file in bytes and time of encoding and writing.
+    """
+    start_time = time()
+    if encoding is not None and encoding['format'] == 'npy':
+        size = write_stems(path, data, sr, encoding)
+        print('File created: {}'.format(path))
+        return size, time() - start_time
+    subtype = 'FLOAT'
+    # compression_level is supported only by soundfile >= 0.12, so it's passed only for FLAC
+    kwargs = {}
+    if encoding is not None:
+        subtype = encoding['subtype']
+        if subtype != 'FLOAT':
+            # dither noise is the same for the same file name
+            seed = int(hashlib.md5(os.path.basename(path).encode('utf-8')).hexdigest()[:8], 16)
+            data = quantize_audio(data, int(subtype[4:]), encoding['dither'], seed)
+        if encoding['format'] == 'flac':
+            kwargs['compression_level'] = int(encoding['compression']) / 8
+    sf.write(path, data, sr, subtype=subtype, **kwargs)
+    print('File created: {}'.format(path))
+    return os.path.getsize(path), time() - start_time
+
+
+def separate_file(model, job):
+    """
+    Reads, separates and writes one file in current process.
+    Returns duration of audio in seconds and list of written files.
+    """
+    audio, sr = read_audio(job['input_audio'])
+    result, sample_rates = model.separate_music_file(audio.T, sr, only_vocals=job['only_vocals'])
+    instruments = ['vocals'] if job['only_vocals'] else model.instruments
+    outputs = get_outputs(job, audio, sr, result, sample_rates, instruments)
+    for output in outputs:
+        write_audio(*output)
+    return audio.shape[1] / sr, [output[0] for output in outputs]
+
+
+def get_worker_cpus(workers):
+    """
+    Splits CPUs available to process into `workers` groups used as affinity masks of workers.
+    If there are less CPUs than workers, CPUs are shared.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if len(cpus) < workers:
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    return [[int(cpu) for cpu in group] for group in np.array_split(cpus, workers)]
+
+
+def get_process_memory():
+    """
+    Returns memory of current process (MB) which is private and which is shared with other processes
+    (e.g. weights shared copy-on-write with parent) or None if it's unknown (not Linux).
+    """
+    if not os.path.isfile('/proc/self/smaps_rollup'):
+        return None
+    memory = {'private': 0, 'shared': 0}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Private_Clean', 'Private_Dirty'):
+                memory['private'] += int(value.split()[0]) / 1024
+            elif name in ('Shared_Clean', 'Shared_Dirty'):
+                memory['shared'] += int(value.split()[0]) / 1024
+    return memory
+
+
+def worker_main(worker, cpus, model, items, func, tasks, connection):
+    """
+    Main function of forked worker process. It gets indexes of items from tasks queue and sends
+    (index, result, elapsed time, error) to parent. Pipe is used, because send is synchronous,
+    so results are not lost if worker is killed later.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    model.create_onnx_sessions(len(cpus))
+    while True:
+        index = tasks.get()
+        if index is None:
+            break
+        start_time = time()
+        try:
+            connection.send((index, func(model, items[index]), time() - start_time, None))
+        except Exception as e:
+            connection.send((index, None, time() - start_time, repr(e)))
+    # index None marks that worker finished
+    connection.send((None, get_process_memory(), 0, None))
+    connection.close()
+
+
+def run_workers(model, items, func, workers, callback=None):
+    """
+    Forks worker processes, which share weights of model with parent copy-on-write, and calls
+    func(model, item) in them for items handed out from shared queue. Result of func must be picklable.
+    Each worker is pinned to its own CPUs and uses the same number of torch and ONNX threads.
+    callback(index, result, elapsed time) is called in parent as soon as item is finished successfully.
+    Returns list of results (None for failed items) and list of stats for each worker.
+    """
+    ctx = multiprocessing.get_context('fork')
+    tasks = ctx.Queue()
+    for index in range(len(items)):
+        tasks.put(index)
+    for _ in range(workers):
+        tasks.put(None)
+
+    # sessions are recreated in workers, onnxruntime thread pools don't survive fork
+    model.close_onnx_sessions()
+    processes = []
+    connections = []
+    stats = []
+    for worker, cpus in enumerate(get_worker_cpus(workers)):
+        reader, writer = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=worker_main, args=(worker, cpus, model, items, func, tasks, writer))
+        process.start()
+        writer.close()
+        processes.append(process)
+        connections.append(reader)
+        stats.append({'cpus': cpus, 'items': [], 'time': 0, 'memory': None, 'errors': []})
+
+    outputs = [None] * len(items)
+    done = [False] * len(items)
+    active = list(range(workers))
+    while len(active) > 0:
+        multiprocessing.connection.wait([connections[worker] for worker in active])
+        for worker in list(active):
+            if not connections[worker].poll():
+                continue
+            try:
+                index, value, elapsed, error = connections[worker].recv()
+            except EOFError:
+                # worker was killed (e.g. by OOM killer) before it finished
+                active.remove(worker)
+                continue
+            if index is None:
+                stats[worker]['memory'] = value
+                active.remove(worker)
+                continue
+            done[index] = True
+            stats[worker]['items'].append(index)
+            stats[worker]['time'] += elapsed
+            if error is None:
+                outputs[index] = value
+                if callback is not None:
+                    callback(index, value, elapsed)
+            else:
+                stats[worker]['errors'].append((index, error))
+    for process in processes:
+        process.join()
+    for worker, process in enumerate(processes):
+        if process.exitcode != 0:
+            stats[worker]['errors'].append((None, 'exit code {}'.format(process.exitcode)))
+    lost = [index for index in range(len(items)) if not done[index]]
+    if len(lost) > 0:
+        stats[0]['errors'] += [(index, 'Not processed, worker died') for index in lost]
+    return outputs, stats
+
+
+def get_shards(length, shards, overlap):
+    """
+    Splits [0, length) into `shards` parts, neighbour parts overlap by `overlap` samples.
+    Returns list of (start, end) of parts.
+    """
+    bounds = np.linspace(0, length, shards + 1).astype(int)
+    return [(max(bounds[i] - overlap // 2, 0), min(bounds[i + 1] + overlap - overlap // 2, length)) for i in range(shards)]
+
+
+def separate_shard(model, index, audio, sr, ranges, buffers, keys, only_vocals):
+    start, end = ranges[index]
+    result, _ = model.separate_music_file(audio[:, start:end].T, sr, only_vocals=only_vocals)
+    for i, key in enumerate(keys):
+        buffers[index][i] = result[key]
+    return (end - start) / sr
+
+
+def separate_with_shards(model, audio, sr, shards, workers, overlap, only_vocals):
+    """
+    Separates one file split into overlapping time shards, which are processed by worker processes
+    in parallel. Stems are stitched back with linear crossfades in overlaps.
+    audio - (channels, samples)
+    overlap - overlap of neighbour shards in samples
+    Returns result and sample rates as separate_music_file and stats of workers.
+    """
+    channels, length = audio.shape
+    if overlap > 0:
+        # crossfades of neighbour shards must not intersect
+        shards = max(min(shards, length // (2 * overlap)), 1)
+    keys = ['vocals'] if only_vocals else model.instruments
+    ranges = get_shards(length, shards, overlap)
+    buffers = []
+    for start, end in ranges:
+        # anonymous shared memory is inherited by forked workers, so stems are not sent through pipes
+        memory = mmap.mmap(-1, len(keys) * (end - start) * channels * 4)
+        buffers.append(np.frombuffer(memory, dtype=np.float32).reshape(len(keys), end - start, channels))
+    func = functools.partial(separate_shard, audio=audio, sr=sr, ranges=ranges, buffers=buffers, keys=keys, only_vocals=only_vocals)
+    durations, stats = run_workers(model, list(range(len(ranges))), func, min(workers, len(ranges)))
+    errors = [error for stat in stats for error in stat['errors']]
+    if len(errors) > 0:
+        raise RuntimeError('Shards failed (shard, error): {}'.format(errors))
+
+    out = np.zeros((len(keys), length, channels), dtype=np.float32)
+    for index, (start, end) in enumerate(ranges):
+        weight = np.ones(end - start, dtype=np.float32)
+        if index > 0 and ranges[index - 1][1] > start:
+            fade = ranges[index - 1][1] - start
+            weight[:fade] = (np.arange(fade) + 0.5) / fade
+        if index < len(ranges) - 1 and end > ranges[index + 1][0]:
+            fade = end - ranges[index + 1][0]
+            weight[-fade:] = 1 - (np.arange(fade) + 0.5) / fade
+        out[:, start:end] += weight[None, :, None] * buffers[index]
+    result = {key: out[i] for i, key in enumerate(keys)}
+    sample_rates = {key: sr for key in keys}
+    return result, sample_rates, stats
+
+
+def predict_with_shards(model, jobs, shards, workers, overlap, log):
+    for job in jobs:
+        print('Go for: {}'.format(job['input_audio']))
+        audio, sr = read_audio(job['input_audio'])
+        start_time = time()
+        try:
+            result, sample_rates, stats = separate_with_shards(model, audio, sr, shards, workers, int(overlap * sr), job['only_vocals'])
+        except RuntimeError as e:
+            print('Error. Processing of {} failed: {}'.format(job['input_audio'], e))
+            continue
+        elapsed = time() - start_time
+        instruments = ['vocals'] if job['only_vocals'] else model.instruments
+        outputs = get_outputs(job, audio, sr, result, sample_rates, instruments)
+        for output in outputs:
+            write_audio(*output)
+        log_completion(log, job, [output[0] for output in outputs], audio.shape[1] / sr, elapsed)
+        # busy time of all workers comparing to wall time, 1.0 - all workers were busy all the time
+        busy = sum(stat['time'] for stat in stats)
+        print('Shards: {} Workers: {} Audio: {:.1f} sec Time: {:.2f} sec Real-time factor: {:.3f} Parallel efficiency: {:.2f}'.format(
+            sum(len(stat['items']) for stat in stats), len(stats), audio.shape[1] / sr, elapsed,
+            elapsed * sr / audio.shape[1], busy / (elapsed * len(stats))))
+
+
+def predict_with_workers(model, jobs, workers, log):
+    start_time = time()
+    def log_result(index, value, elapsed):
+        log_completion(log, jobs[index], value[1], value[0], elapsed)
+
+    results, stats = run_workers(model, jobs, separate_file, workers, log_result)
+    durations = [None if value is None else value[0] for value in results]
+    elapsed = time() - start_time
+
+    for worker, stat in enumerate(stats):
+        audio = sum(durations[index] for index in stat['items'] if durations[index] is not None)
+        memory = 'unknown'
+        if stat['memory'] is not None:
+            memory = 'private {:.0f} MB shared {:.0f} MB'.format(stat['memory']['private'], stat['memory']['shared'])
+        print('Worker {}: CPUs: {} Files: {} Audio: {:.1f} sec Busy: {:.2f} sec Speed: {:.2f}x real time Memory: {}'.format(
+            worker, stat['cpus'], len(stat['items']), audio, stat['time'], audio / max(stat['time'], 1e-8), memory))
+        for index, error in stat['errors']:
+            if index is None:
+                print('Error. Worker {} failed: {}'.format(worker, error))
+            else:
+                print('Error. Processing of {} failed: {}'.format(jobs[index]['input_audio'], error))
+    audio = sum(duration for duration in durations if duration is not None)
+    processed = len([duration for duration in durations if duration is not None])
+    print('Workers: {} Files: {}/{} Audio: {:.1f} sec Time: {:.2f} sec Real-time factor: {:.3f} ({:.2f}x real time)'.format(
+        workers, processed, len(jobs), audio, elapsed, elapsed / max(audio, 1e-8), audio / elapsed))
+
+
+# Spool directory is a work queue shared by workers on any number of hosts through shared filesystem
+# (e.g. NFS), without broker. Job is a JSON file, it's moved between folders with atomic rename,
+# so only one worker can claim it. Name of job file is <rank>-<key>.json, where key is md5 of job id
+# and rank makes longest jobs sorted first. Claimed jobs are named <rank>-<key>.<worker>.json.
+SPOOL_FOLDERS = ['pending', 'claimed', 'done', 'failed', 'heartbeats']
+
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def write_json_atomic(path, data):
+    """
+    Writes JSON to temporary file and renames it, so readers never see partially written file.
+    """
+    temp_path = '{}.{}-{}.tmp'.format(path, get_worker_id(), threading.get_ident())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def list_spool(spool_dir, folder):
+    return sorted(name for name in os.listdir(os.path.join(spool_dir, folder)) if name.endswith('.json'))
+
+
+def get_job_key(name):
+    """
+    Returns key of job from name of its file in any spool folder.
+    """
+    return name.split('.')[0].split('-')[-1]
+
+
+def init_spool(spool_dir):
+    for folder in SPOOL_FOLDERS:
+        os.makedirs(os.path.join(spool_dir, folder), exist_ok=True)
+
+
+def get_queue_depth(spool_dir):
+    return {folder: len(list_spool(spool_dir, folder)) for folder in SPOOL_FOLDERS[:-1]}
+
+
+def enqueue_jobs(spool_dir, jobs, probes):
+    """
+    Adds jobs to pending folder of spool. Jobs which are already pending, claimed or done are skipped,
+    failed jobs are queued again. Paths are made absolute, so workers started in other folders or hosts
+    find them on shared filesystem.
+    """
+    init_spool(spool_dir)
+    queued = set(get_job_key(name) for folder in ['pending', 'claimed', 'done'] for name in list_spool(spool_dir, folder))
+    failed = dict((get_job_key(name), name) for name in list_spool(spool_dir, 'failed'))
+    added = 0
+    for job, probe in zip(jobs, probes):
+        key = hashlib.md5(job['id'].encode('utf-8')).hexdigest()
+        if key in queued:
+            continue
+        job = dict(job, input_audio=os.path.abspath(job['input_audio']), output_folder=os.path.abspath(job['output_folder']),
+                   duration=probe['duration'])
+        rank = max(10 ** 8 - 1 - int(probe['duration']), 0)
+        write_json_atomic(os.path.join(spool_dir, 'pending', '{:08d}-{}.json'.format(rank, key)), job)
+        if key in failed:
+            os.remove(os.path.join(spool_dir, 'failed', failed[key]))
+        queued.add(key)
+        added += 1
+    print('Queued: {} jobs Skipped (already queued or done): {}'.format(added, len(jobs) - added))
+
+
+def claim_job(spool_dir, worker, candidates):
+    """
+    Claims next pending job by renaming it into claimed folder, only one worker succeeds.
+    candidates - list of pending names from previous listing, it's refreshed when all of them are taken
+    Returns job and path of claimed file or (None, None) if there are no pending jobs.
+    """
+    for attempt in range(2):
+        if len(candidates) == 0:
+            candidates.extend(list_spool(spool_dir, 'pending'))
+        while len(candidates) > 0:
+            name = candidates.pop(0)
+            path = os.path.join(spool_dir, 'claimed', '{}.{}.json'.format(name[:-5], worker))
+            try:
+                os.rename(os.path.join(spool_dir, 'pending', name), path)
+            except FileNotFoundError:
+                # claimed by other worker
+                continue
+            with open(path) as f:
+                return json.load(f), path
+    return None, None
+
+
+def reclaim_jobs(spool_dir, observed, timeout):
+    """
+    Returns jobs claimed by dead workers to pending folder. Worker is dead if its heartbeat file didn't change
+    for `timeout` seconds by clock of this process, so clocks of different hosts don't need to be in sync.
+    observed - dict worker: (mtime of heartbeat, local time when it was seen), kept between calls
+    Returns number of reclaimed jobs.
+    """
+    now = time()
+    reclaimed = 0
+    for name in list_spool(spool_dir, 'claimed'):
+        job_name = name.split('.')[0]
+        worker = name[len(job_name) + 1:-5]
+        try:
+            mtime = os.stat(os.path.join(spool_dir, 'heartbeats', worker + '.json')).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if worker not in observed or observed[worker][0] != mtime:
+            observed[worker] = (mtime, now)
+            continue
+        if now - observed[worker][1] < timeout:
+            continue
+        try:
+            if os.path.isfile(os.path.join(spool_dir, 'done', job_name + '.json')):
+                # worker died after job was finished
+                os.remove(os.path.join(spool_dir, 'claimed', name))
+                continue
+            os.rename(os.path.join(spool_dir, 'claimed', name), os.path.join(spool_dir, 'pending', job_name + '.json'))
+        except FileNotFoundError:
+            # reclaimed by other worker
+            continue
+        print('Reclaimed job {} of dead worker {}'.format(job_name, worker))
+        reclaimed += 1
+    return reclaimed
+
+
+def start_heartbeat(path, stats, interval):
+    """
+    Rewrites heartbeat file with stats of worker every `interval` seconds in background thread.
+    Returns event which stops it.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            write_json_atomic(path, dict(stats, updated=time()))
+
+    write_json_atomic(path, dict(stats, updated=time()))
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+
+def consume_spool(model, spool_dir, timeout=60.0):
+    """
+    Worker of spool queue: claims jobs, separates them and moves them to done or failed folder.
+    It exits when there are neither pending nor claimed jobs, jobs of dead workers are reclaimed meanwhile.
+    Returns stats of worker.
+    """
+    worker = get_worker_id()
+    stats = {'worker': worker, 'started': time(), 'jobs': 0, 'failed': 0, 'audio': 0.0, 'busy': 0.0, 'finished': False}
+    heartbeat = os.path.join(spool_dir, 'heartbeats', worker + '.json')
+    stop = start_heartbeat(heartbeat, stats, timeout / 4)
+    observed = dict()
+    candidates = []
+    last_reclaim = 0
+    try:
+        while True:
+            if time() - last_reclaim > timeout / 4:
+                reclaim_jobs(spool_dir, observed, timeout)
+                last_reclaim = time()
+            job, claimed = claim_job(spool_dir, worker, candidates)
+            if job is None:
+                if len(list_spool(spool_dir, 'claimed')) == 0:
+                    break
+                # other workers are busy or dead, wait for their jobs
+                sleep(timeout / 8)
+                continue
+
+            depth = get_queue_depth(spool_dir)
+            print('Worker {} Go for: {} Queue: pending {} claimed {} done {} failed {}'.format(
+                worker, job['input_audio'], depth['pending'], depth['claimed'], depth['done'], depth['failed']))
+            job_name = os.path.basename(claimed).split('.')[0]
+            start_time = time()
+            try:
+                duration, outputs = separate_file(model, job)
+                elapsed = time() - start_time
+                write_json_atomic(os.path.join(spool_dir, 'done', job_name + '.json'),
+                                  dict(job, outputs=outputs, time=round(elapsed, 3), worker=worker))
+                stats['jobs'] += 1
+                stats['audio'] += duration
+            except Exception as e:
+                elapsed = time() - start_time
+                print('Error. Processing of {} failed: {}'.format(job['input_audio'], e))
+                write_json_atomic(os.path.join(spool_dir, 'failed', job_name + '.json'), dict(job, error=repr(e), worker=worker))
+                stats['failed'] += 1
+            stats['busy'] += elapsed
+            try:
+                os.remove(claimed)
+            except FileNotFoundError:
+                # job was reclaimed, because heartbeat was late. It's done anyway
+                pass
+    finally:
+        stop.set()
+        stats['finished'] = True
+        write_json_atomic(heartbeat, dict(stats, updated=time()))
+    return stats
+
+
+def print_spool_status(spool_dir, timeout=60.0):
+    """
+    Prints queue depth and rates of all workers which ever worked with spool.
+    """
+    depth = get_queue_depth(spool_dir)
+    print('Queue: pending {} claimed {} done {} failed {}'.format(depth['pending'], depth['claimed'], depth['done'], depth['failed']))
+    for name in list_spool(spool_dir, 'heartbeats'):
+        path = os.path.join(spool_dir, 'heartbeats', name)
+        with open(path) as f:
+            stats = json.load(f)
+        age = time() - os.stat(path).st_mtime
+        state = 'finished'
+        if not stats['finished']:
+            state = 'alive' if age < timeout else 'no heartbeat'
+        hours = max(stats['updated'] - stats['started'], 1e-8) / 3600
+        print('Worker {}: {} Jobs: {} Failed: {} Audio: {:.1f} sec Busy: {:.1f} sec Speed: {:.2f}x real time '
+              'Jobs per hour: {:.1f} Last heartbeat: {:.0f} sec ago'.format(
+                  stats['worker'], state, stats['jobs'], stats['failed'], stats['audio'], stats['busy'],
+                  stats['audio'] / max(stats['busy'], 1e-8), stats['jobs'] / hours, age))
+
+
+def predict_from_spool(spool_dir, options, workers, timeout):
+    """
+    Runs workers of spool queue in this process or in forked processes sharing models.
+    """
+    if workers > 1:
+        torch.set_num_threads(1)
+        model = EnsembleDemucsMDXMusicSeparationModel(options)
+        func = functools.partial(consume_spool, timeout=timeout)
+        _, stats = run_workers(model, [spool_dir] * workers, func, workers)
+        for worker, stat in enumerate(stats):
+            for index, error in stat['errors']:
+                print('Error. Worker {} failed: {}'.format(worker, error))
+    else:
+        model = get_model(options)
+        consume_spool(model, spool_dir, timeout)
+    print_spool_status(spool_dir, timeout)
+
+
+# Formats of samples in input and output streams: numpy dtype and scale of integer samples,
+# s24le is unpacked from 3 bytes separately
+STREAM_SAMPLE_FORMATS = {
+    's16le': ('<i2', 2 ** 15),
+    's24le': (None, 2 ** 23),
+    's32le': ('<i4', 2 ** 31),
+    'f32le': ('<f4', 1),
+    'f64le': ('<f8', 1),
+}
+
+
+def read_exact(stream, size):
+    """
+    Reads `size` bytes from pipe, it returns less only at the end of stream.
+    """
+    chunks = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def read_wav_stream_header(stream):
+    """
+    Parses WAV header from non seekable stream up to the start of data chunk. Sizes of RIFF and data chunks
+    are ignored, so streams of unknown length (e.g. from ffmpeg, sizes are 0xFFFFFFFF) are supported.
+    Returns sample format (key of STREAM_SAMPLE_FORMATS), sample rate and number of channels.
+    """
+    riff = read_exact(stream, 12)
+    if len(riff) < 12 or riff[:4] not in (b'RIFF', b'RF64') or riff[8:12] != b'WAVE':
+        raise ValueError('Input stream is not WAV')
+    fmt = None
+    while True:
+        header = read_exact(stream, 8)
+        if len(header) < 8:
+            raise ValueError('No data chunk in WAV stream')
+        chunk_id, size = header[:4], struct.unpack('<I', header[4:])[0]
+        if chunk_id == b'data':
+            break
+        # chunks are padded to even size
+        body = read_exact(stream, size + size % 2)
+        if chunk_id == b'fmt ':
+            fmt = body
+    if fmt is None:
+        raise ValueError('No fmt chunk in WAV stream')
+    tag, channels, sr = struct.unpack('<HHI', fmt[:8])
+    bits = struct.unpack('<H', fmt[14:16])[0]
+    if tag == 0xFFFE:
+        # WAVE_FORMAT_EXTENSIBLE, real format is in the first bytes of subformat GUID
+        tag = struct.unpack('<H', fmt[24:26])[0]
+    sample_format = {(1, 16): 's16le', (1, 24): 's24le', (1, 32): 's32le', (3, 32): 'f32le', (3, 64): 'f64le'}.get((tag, bits))
+    if sample_format is None:
+        raise ValueError('Unsupported WAV sample format: tag {} bits {}'.format(tag, bits))
+    return sample_format, sr, channels
+
+
+def parse_stream_input(spec, stream):
+    """
+    spec - 'wav' or raw PCM as 'format:sample rate:channels', e.g. 's16le:44100:2'
+    Returns sample format, sample rate and number of channels. WAV header is read from stream.
+    """
+    if spec == 'wav':
+        sample_format, sr, channels = read_wav_stream_header(stream)
+    else:
+        try:
+            sample_format, sr, channels = spec.split(':')
+            sr, channels = int(sr), int(channels)
+        except ValueError:
+            raise ValueError('Stream input must be wav or format:sample rate:channels, got: {}'.format(spec))
+        if sample_format not in STREAM_SAMPLE_FORMATS:
+            raise ValueError('Unknown sample format: {}. Available: {}'.format(sample_format, ', '.join(STREAM_SAMPLE_FORMATS)))
+    # models work with stereo, mono is duplicated
+    if channels not in (1, 2):
+        raise ValueError('Stream input must be mono or stereo, got: {} channels'.format(channels))
+    return sample_format, sr, channels
+
+
+def decode_samples(data, sample_format, channels):
+    """
+    Returns float32 audio (channels, samples) from interleaved bytes.
+    """
+    dtype, scale = STREAM_SAMPLE_FORMATS[sample_format]
+    if sample_format == 's24le':
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        # the top byte is shifted to int32 sign bit and back to extend sign
+        samples = ((raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)) >> 8
+    else:
+        samples = np.frombuffer(data, dtype=dtype)
+    samples = samples.astype(np.float32)
+    if scale != 1:
+        samples /= scale
+    return samples.reshape(-1, channels).T
+
+
+def make_wav_header(sr, channels, sample_format):
+    """
+    Returns WAV header for stream of unknown length, sizes are 0xFFFFFFFF as ffmpeg writes them to pipes.
+    sample_format - f32le or s16le
+    """
+    tag, bits = (3, 32) if sample_format == 'f32le' else (1, 16)
+    block_align = channels * bits // 8
+    return b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' + \
+        b'fmt ' + struct.pack('<IHHIIHH', 16, tag, channels, sr, sr * block_align, block_align, bits) + \
+        b'data' + struct.pack('<I', 0xFFFFFFFF)
+
+
+def encode_samples(data, sample_format, seed):
+    """
+    Returns interleaved bytes of float audio (samples, channels) in f32le or s16le with TPDF dither.
+    """
+    if sample_format == 'f32le':
+        return np.ascontiguousarray(data, dtype='<f4').tobytes()
+    return quantize_audio(data, 16, 'tpdf', seed).astype('<i2').tobytes()
+
+
+def separate_stream(model, stream, sample_format, sr, channels, block, overlap, stems, only_vocals, write):
+    """
+    Separates audio read from stream by overlapping blocks. Neighbour blocks overlap by `overlap` samples
+    and are stitched with linear crossfades, as shards in separate_with_shards. Output is passed to write
+    as soon as it can't change anymore, so latency is about block + overlap / 2 plus separation time.
+    block, overlap - in samples, overlap <= block
+    write(data) - data is float32 array [stems, samples, channels]
+    Returns number of processed samples.
+    """
+    frame_bytes = channels * (3 if sample_format == 's24le' else np.dtype(STREAM_SAMPLE_FORMATS[sample_format][0]).itemsize)
+    fade_in = ((np.arange(overlap) + 0.5) / overlap).astype(np.float32)
+    buffer = np.zeros((channels, 0), dtype=np.float32)
+    # absolute position of the first sample of buffer
+    buffer_start = 0
+    tail = None
+    finished = False
+    index = 0
+    while True:
+        start = max(index * block - overlap // 2, 0)
+        end = (index + 1) * block + overlap - overlap // 2
+        while not finished and buffer_start + buffer.shape[1] < end:
+            size = end - buffer_start - buffer.shape[1]
+            data = read_exact(stream, size * frame_bytes)
+            data = data[:len(data) // frame_bytes * frame_bytes]
+            if len(data) < size * frame_bytes:
+                finished = True
+            buffer = np.concatenate([buffer, decode_samples(data, sample_format, channels)], axis=1)
+        end = min(end, buffer_start + buffer.shape[1])
+        last = finished and end == buffer_start + buffer.shape[1]
+        if end <= start:
+            break
+
+        segment = buffer[:, start - buffer_start:end - buffer_start]
+        if segment.shape[0] == 1:
+            segment = np.concatenate([segment, segment], axis=0)
+        result, sample_rates = model.separate_music_file(segment.T, sr, only_vocals=only_vocals)
+        instruments = ['vocals'] if only_vocals else model.instruments
+        separated = dict((stem, data) for stem, data, _ in get_stems(segment, sr, result, sample_rates, instruments, only_vocals))
+        out = np.stack([separated[stem] for stem in stems]).astype(np.float32)
+        if index > 0:
+            out[:, :overlap] *= fade_in[None, :, None]
+            out[:, :overlap] += tail
+        if last:
+            write(out)
+            break
+        out[:, -overlap:] *= 1 - fade_in[None, :, None]
+        write(out[:, :-overlap])
+        tail = out[:, -overlap:]
+        # next block starts where crossfade with this one starts
+        buffer = buffer[:, end - overlap - buffer_start:]
+        buffer_start = end - overlap
+        index += 1
+    return buffer_start + buffer.shape[1]
+
+
+def predict_stream(options):
+    """
+    Reads WAV or raw PCM from stdin, separates it by blocks and writes requested stems to stdout or
+    named pipes as soon as blocks are finished. One output gets all stems interleaved as channels
+    (stem 1 left, stem 1 right, stem 2 left, ...), several outputs get one stem each.
+    """
+    stdout = None
+    if 'stream_stdout' in options:
+        stdout = options['stream_stdout']
+    if stdout is None:
+        # logs must not mix with audio written to stdout
+        sys.stdout.flush()
+        stdout = os.fdopen(os.dup(1), 'wb')
+        os.dup2(2, 1)
+
+    spec = 'wav'
+    if 'stream_input' in options:
+        spec = options['stream_input']
+    stems = ['vocals']
+    if 'stream_stems' in options:
+        stems = options['stream_stems']
+    paths = ['-']
+    if 'stream_output' in options:
+        paths = options['stream_output']
+    output_format = 'wav'
+    if 'stream_output_format' in options:
+        output_format = options['stream_output_format']
+    block = 30.0
+    if 'stream_block' in options:
+        block = float(options['stream_block'])
+    overlap = 5.0
+    if 'stream_overlap' in options:
+        overlap = float(options['stream_overlap'])
+
+    available = ['bass', 'drums', 'other', 'vocals', 'instrum', 'instrum2']
+    for stem in stems:
+        if stem not in available:
+            print('Error. Unknown stem: {}. Available: {}'.format(stem, ', '.join(available)))
+            return
+    if len(paths) != 1 and len(paths) != len(stems):
+        print('Error. Number of stream outputs must be 1 or equal to number of stems')
+        return
+    if not 0 < overlap <= block:
+        print('Error. Stream overlap must be positive and not longer than block')
+        return
+    # vocals and instrumental don't need the other models
+    only_vocals = all(stem in ('vocals', 'instrum') for stem in stems)
+
+    stdin = sys.stdin.buffer
+    try:
+        sample_format, sr, channels = parse_stream_input(spec, stdin)
+    except ValueError as e:
+        print('Error. {}'.format(e))
+        return
+    if sr != 44100:
+        print('Error. Stream sample rate must be 44100, got: {}. Resample it before, e.g. ffmpeg -ar 44100'.format(sr))
+        return
+    # low GPU memory version loads all models on every call, i.e. for every block,
+    # so stream always keeps models loaded as with --large_gpu
+    print('Use fast large GPU memory version of code')
+    model = EnsembleDemucsMDXMusicSeparationModel(options)
+    print('Stream input: {} Sample rate: {} Channels: {} Stems: {} Block: {} sec Overlap: {} sec'.format(
+        sample_format, sr, channels, ' '.join(stems), block, overlap))
+
+    # named pipes are opened after model is loaded, open for writing waits for reader
+    outputs = [stdout if path == '-' else open(path, 'wb') for path in paths]
+    sample_format_out = 'f32le' if output_format == 'wav' else output_format
+    if output_format == 'wav':
+        for output in outputs:
+            output.write(make_wav_header(sr, 2 * (len(stems) if len(outputs) == 1 else 1), 'f32le'))
+            output.flush()
+
+    written = [0]
+
+    def write(data):
+        if len(outputs) == 1:
+            frames = data.transpose(1, 0, 2).reshape(data.shape[1], -1)
+            outputs[0].write(encode_samples(frames, sample_format_out, written[0]))
+        else:
+            for output, stem_data in zip(outputs, data):
+                output.write(encode_samples(stem_data, sample_format_out, written[0]))
+        for output in outputs:
+            output.flush()
+        written[0] += data.shape[1]
 
+    start_time = time()
+    try:
+        separate_stream(model, stdin, sample_format, sr, channels, int(block * sr), int(overlap * sr), stems, only_vocals, write)
+    except BrokenPipeError:
+        print('Error. Reader of stream output closed pipe')
+    finally:
+        for output in outputs:
+            if output is not stdout:
+                try:
+                    output.close()
+                except BrokenPipeError:
+                    pass
+    elapsed = time() - start_time
+    print('Stream: {:.1f} sec of audio Time: {:.2f} sec Real-time factor: {:.3f}'.format(
+        written[0] / sr, elapsed, elapsed * sr / max(written[0], 1)))
+
+
+def get_worker_count(options):
+    """
+    Returns number of worker processes and shards for CPU, it's 1 if forked workers can't be used.
+    """
+    workers = 1
+    if 'workers' in options:
+        workers = max(int(options['workers']), 1)
+    shards = 1
+    if 'shards' in options:
+        shards = max(int(options['shards']), 1)
+    if workers > 1 or shards > 1:
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print('Worker processes need fork, which is not available on this platform. Use single process')
+            workers, shards = 1, 1
+        elif torch.cuda.is_available() and not ('cpu' in options and options['cpu']):
+            print('Worker processes are available only for CPU. Use single process')
+            workers, shards = 1, 1
+    return workers, shards
+
+
+def get_model(options):
     model = None
     if 'large_gpu' in options:
         if options['large_gpu'] is True:
@@ -824,51 +2348,271 @@ def predict_with_model(options):
     if model is None:
         print('Use low GPU memory version of code')
         model = EnsembleDemucsMDXMusicSeparationModelLowGPU(options)
+    return model
+
+
+def predict_with_model(options):
+    if 'stream' in options and options['stream']:
+        predict_stream(options)
+        return
+
+    spool_dir = None
+    if 'spool_dir' in options:
+        spool_dir = options['spool_dir']
+    if spool_dir is not None and not ('enqueue' in options and options['enqueue']):
+        init_spool(spool_dir)
+        timeout = 60.0
+        if 'heartbeat_timeout' in options:
+            timeout = float(options['heartbeat_timeout'])
+        if 'queue_status' in options and options['queue_status']:
+            print_spool_status(spool_dir, timeout)
+            return
+        predict_from_spool(spool_dir, options, get_worker_count(options)[0], timeout)
+        return
+
+    try:
+        jobs = get_jobs(options)
+        partition = None
+        if 'partition' in options and options['partition'] is not None:
+            partition = parse_partition(options['partition'])
+    except (OSError, ValueError) as e:
+        print('Error. {}'.format(e))
+        return
+    if partition is not None:
+        jobs = get_partition(jobs, *partition)
+        print('Partition {}/{}: {} jobs'.format(partition[0], partition[1], len(jobs)))
+
+    log_path, log_paths = get_completion_logs(options, partition)
+    if log_path is not None:
+        completed = read_completed(log_paths)
+        left = [job for job in jobs if job['id'] not in completed]
+        print('Completion log: {} Already done: {} Left: {}'.format(log_path, len(jobs) - len(left), len(left)))
+        jobs = left
+
+    jobs, probes = probe_inputs(jobs)
+    if len(jobs) == 0:
+        print('Nothing to process')
+        return
+    for output_folder in set(job['output_folder'] for job in jobs):
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+    if spool_dir is not None:
+        enqueue_jobs(spool_dir, jobs, probes)
+        return
+
+    if 'only_vocals' in options:
+        if options['only_vocals'] is True:
+            print('Generate only vocals and instrumental')
+
+    log = None
+    if log_path is not None:
+        log = open_completion_log(log_path)
+    try:
+        predict_jobs(options, jobs, probes, log)
+    finally:
+        if log is not None:
+            log.close()
+
+
+def predict_jobs(options, jobs, probes, log):
+    """
+    Separates jobs prepared by predict_with_model and appends finished ones to completion log.
+    """
+    # decoding of next files and writing of previous ones run in background threads,
+    # librosa/soundfile release GIL, so they overlap with separation
+    prefetch = 1
+    if 'prefetch' in options:
+        prefetch = max(int(options['prefetch']), 0)
+    writers = 1
+    if 'writers' in options:
+        writers = max(int(options['writers']), 0)
+
+    workers, shards = get_worker_count(options)
+    if workers > 1 or shards > 1:
+        # parent doesn't separate anything, with single thread it doesn't start
+        # OpenMP thread pool, which can't be used after fork
+        torch.set_num_threads(1)
+        # all models are loaded once in parent, so weights are shared with workers
+        model = EnsembleDemucsMDXMusicSeparationModel(options)
+        if shards > 1:
+            if workers == 1:
+                workers = shards
+            shard_overlap = 10.0
+            if 'shard_overlap' in options:
+                shard_overlap = float(options['shard_overlap'])
+            print('Split each file into {} shards processed by {} worker processes'.format(shards, workers))
+            predict_with_shards(model, jobs, shards, workers, shard_overlap, log)
+        else:
+            print('Use {} worker processes with shared weights'.format(workers))
+            order = schedule_jobs([probe['duration'] for probe in probes], workers)
+            predict_with_workers(model, [jobs[index] for index in order], workers, log)
+        return
+
+    model = get_model(options)
 
     update_percent_func = None
     if 'update_percent_func' in options:
         update_percent_func = options['update_percent_func']
 
-    for i, input_audio in enumerate(options['input_audio']):
-        print('Go for: {}'.format(input_audio))
-        audio, sr = librosa.load(input_audio, mono=False, sr=44100)
-        if len(audio.shape) == 1:
-            audio = np.stack([audio, audio], axis=0)
-        print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
-        result, sample_rates = model.separate_music_file(
-            audio.T,
-            sr,
-            update_percent_func,
-            i,
-            len(options['input_audio']),
-            only_vocals,
-        )
-        all_instrum = model.instruments
-        if only_vocals:
-            all_instrum = ['vocals']
-        for instrum in all_instrum:
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format(instrum)
-            sf.write(output_folder + '/' + output_name, result[instrum], sample_rates[instrum], subtype='FLOAT')
-            print('File created: {}'.format(output_folder + '/' + output_name))
-
-        # instrumental part 1
-        inst = audio.T - result['vocals']
-        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format('instrum')
-        sf.write(output_folder + '/' + output_name, inst, sr, subtype='FLOAT')
-        print('File created: {}'.format(output_folder + '/' + output_name))
-
-        if not only_vocals:
-            # instrumental part 2
-            inst2 = result['bass'] + result['drums'] + result['other']
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format('instrum2')
-            sf.write(output_folder + '/' + output_name, inst2, sr, subtype='FLOAT')
-            print('File created: {}'.format(output_folder + '/' + output_name))
+    batch_start_time = time()
+    time_compute = 0
+    time_wait_decode = 0
+    time_wait_write = 0
+    # sizes and encoding times of written files
+    written = []
+    with ThreadPoolExecutor(max(prefetch, 1)) as decoder, ThreadPoolExecutor(max(writers, 1)) as writer:
+        decoding = deque(decoder.submit(read_audio, job['input_audio']) for job in jobs[:prefetch])
+        # outputs of at most `writers` files are kept in memory while they are written,
+        # job is logged as finished when all its files are written
+        writing = deque()
+        for i, job in enumerate(jobs):
+            print('Go for: {}'.format(job['input_audio']))
+            start_time = time()
+            if prefetch > 0:
+                audio, sr = decoding.popleft().result()
+                if i + prefetch < len(jobs):
+                    decoding.append(decoder.submit(read_audio, jobs[i + prefetch]['input_audio']))
+            else:
+                audio, sr = read_audio(job['input_audio'])
+            time_wait_decode += time() - start_time
+
+            print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
+            start_time = time()
+            result, sample_rates = model.separate_music_file(
+                audio.T,
+                sr,
+                update_percent_func,
+                i,
+                len(jobs),
+                job['only_vocals'],
+            )
+            elapsed = time() - start_time
+            time_compute += elapsed
+            all_instrum = model.instruments
+            if job['only_vocals']:
+                all_instrum = ['vocals']
+            outputs = get_outputs(job, audio, sr, result, sample_rates, all_instrum)
+            record = (job, [output[0] for output in outputs], audio.shape[1] / sr, elapsed)
+
+            start_time = time()
+            if writers > 0:
+                while len(writing) >= writers:
+                    futures, finished = writing.popleft()
+                    for future in futures:
+                        written.append(future.result())
+                    log_completion(log, *finished)
+                writing.append(([writer.submit(write_audio, *output) for output in outputs], record))
+            else:
+                for output in outputs:
+                    written.append(write_audio(*output))
+                log_completion(log, *record)
+            time_wait_write += time() - start_time
+
+        start_time = time()
+        for futures, finished in writing:
+            for future in futures:
+                written.append(future.result())
+            log_completion(log, *finished)
+        time_wait_write += time() - start_time
+
+    print('Batch: {} files Time: {:.2f} sec Separation: {:.2f} sec Waiting for decoding: {:.2f} sec writing: {:.2f} sec'.format(
+        len(jobs), time() - batch_start_time, time_compute, time_wait_decode, time_wait_write))
+    # manifest items can override format, so number of input files is printed for each encoding
+    encodings = dict()
+    for job in jobs:
+        key = '{} {}'.format(job['encoding']['format'], job['encoding']['subtype'])
+        encodings[key] = encodings.get(key, 0) + 1
+    print('Written: {} files {:.1f} MB Formats: {} Encoding and writing time: {:.2f} sec (sum over writer threads)'.format(
+        len(written), sum(size for size, _ in written) / 2 ** 20,
+        ', '.join('{} ({} inputs)'.format(key, count) for key, count in encodings.items()),
+        sum(elapsed for _, elapsed in written)))
 
     if update_percent_func is not None:
         val = 100
         update_percent_func(int(val))
 
 
+def profile_imports(modules=STARTUP_MODULES):
+    """
+    Imports modules one by one and prints import time of each of them.
+    Time of module doesn't include modules already imported by previous ones.
+    """
+    total = 0
+    for name in modules:
+        before = len(sys.modules)
+        start_time = time()
+        module = importlib.import_module(name)
+        # lazy modules are really imported at first access to attribute
+        getattr(module, '__file__', None)
+        elapsed = time() - start_time
+        total += elapsed
+        print('Import: {:<18} {:.2f} sec Modules: {}'.format(name, elapsed, len(sys.modules) - before))
+    print('Import total: {:.2f} sec'.format(total))
+
+
+def profile_first_forward(start_time):
+    """
+    Prints time from start_time to the end of the first forward of torch model (models loading included).
+    """
+    first = []
+    handles = []
+
+    def pre_hook(module, args):
+        if not first:
+            first.append((module, time()))
+
+    def hook(module, args, output):
+        if module is first[0][0]:
+            print('Time to first forward: {:.2f} sec Forward: {:.2f} sec Model: {}'.format(
+                time() - start_time, time() - first[0][1], type(module).__name__))
+            for handle in handles:
+                handle.remove()
+
+    handles.append(torch.nn.modules.module.register_module_forward_pre_hook(pre_hook))
+    handles.append(torch.nn.modules.module.register_module_forward_hook(hook))
+
+
+def sdr(references, estimates):
+    """
+    Global SDR as used in MDX challenge. Inputs have shape (..., channels, samples)
+    """
+    eps = 1e-8
+    num = np.sum(np.square(references), axis=(-2, -1))
+    den = np.sum(np.square(references - estimates), axis=(-2, -1))
+    return 10 * np.log10((num + eps) / (den + eps))
+
+
+def make_synthetic_mixture(duration=10.0, sample_rate=44100, seed=0):
+    """
+    Creates simple stereo mixture with known stems. Used to check accuracy of optimized models.
+    Returns mixture with shape (2, samples) and dict of stems with the same shape.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(duration * sample_rate)
+    t = np.arange(n) / sample_rate
+    bpm = rng.uniform(90, 140)
+    beat = 60 / bpm
+
+    # drums: decaying noise bursts on each beat
+    phase = (t % beat) / beat
+    drums = rng.randn(n) * np.exp(-phase * 30) * 0.5
+    # bass: low note with harmonic, changes every bar
+    f0 = rng.choice([41.2, 55.0, 61.7, 73.4], size=int(duration / (4 * beat)) + 1)[(t // (4 * beat)).astype(np.int64)]
+    bass = 0.4 * np.sin(2 * np.pi * f0 * t) + 0.1 * np.sin(4 * np.pi * f0 * t)
+    # other: chord of sines
+    other = sum(0.1 * np.sin(2 * np.pi * f * t) for f in rng.uniform(200, 1000, size=3))
+    # vocals: vibrato tone with syllable envelope
+    f_voc = rng.uniform(200, 500) * (1 + 0.01 * np.sin(2 * np.pi * 5 * t))
+    vocals = 0.3 * np.sin(2 * np.pi * np.cumsum(f_voc) / sample_rate) * (0.5 + 0.5 * np.sin(np.pi * t / beat) ** 2)
+
+    stems = {}
+    for name, mono in zip(['drums', 'bass', 'other', 'vocals'], [drums, bass, other, vocals]):
+        pan = rng.uniform(0.3, 0.7)
+        stems[name] = np.stack([mono * (1 - pan), mono * pan]).astype(np.float32)
+    mixture = sum(stems.values())
+    return mixture, stems
+
+
 def md5(fname):
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
@@ -882,8 +2626,11 @@ if __name__ == '__main__':
 
     print("Version: {}".format(__VERSION__))
     m = argparse.ArgumentParser()
-    m.add_argument("--input_audio", "-i", nargs='+', type=str, help="Input audio location. You can provide multiple files at once", required=True)
-    m.add_argument("--output_folder", "-r", type=str, help="Output audio folder", required=True)
+    m.add_argument("--input_audio", "-i", nargs='+', type=str, help="Input audio location. You can provide multiple files at once")
+    m.add_argument("--output_folder", "-r", type=str, help="Output audio folder. With manifest it's used for items without output_folder")
+    m.add_argument("--manifest", type=str, help="JSON lines file with jobs instead of input_audio: one object per line with input_audio and optional id, output_folder, output_name, only_vocals")
+    m.add_argument("--partition", type=str, help="Process only part i/n of jobs (0 <= i < n), chosen by stable hash of job id. Run the same manifest on n machines with different i.")
+    m.add_argument("--completion_log", type=str, help="JSON lines log of finished jobs, they are skipped on rerun. Default with manifest: <manifest>.done.jsonl (.done.<i>of<n>.jsonl with partition)")
     m.add_argument("--cpu", action='store_true', help="Choose CPU instead of GPU for processing. Can be very slow.")
     m.add_argument("--overlap_large", "-ol", type=float, help="Overlap of splited audio for light models. Closer to 1.0 - slower", required=False, default=0.6)
     m.add_argument("--overlap_small", "-os", type=float, help="Overlap of splited audio for heavy models. Closer to 1.0 - slower", required=False, default=0.5)
@@ -892,11 +2639,49 @@ if __name__ == '__main__':
     m.add_argument("--large_gpu", action='store_true', help="It will store all models on GPU for faster processing of multiple audio files. Requires 11 and more GB of free GPU memory.")
     m.add_argument("--use_kim_model_1", action='store_true', help="Use first version of Kim model (as it was on contest).")
     m.add_argument("--only_vocals", action='store_true', help="Only create vocals and instrumental. Skip bass, drums, other")
+    m.add_argument("--quantized", action='store_true', help="Use INT8 quantized models created with quantize.py. Works only on CPU.")
+    m.add_argument("--compile", action='store_true', help="Use TorchScript versions of Demucs models. They are traced once and cached in models/compiled/.")
+    m.add_argument("--precision", type=str, choices=['float32', 'bfloat16', 'float16'], help="Precision for Demucs models. bfloat16 is fast on CPUs with native bf16 support. Default: float32", required=False, default='float32')
+    m.add_argument("--fold_weights", action='store_true', help="Fold constant scales of Demucs models into weights at load time. Output is the same up to float rounding.")
+    m.add_argument("--mmap_weights", action='store_true', help="Load Demucs models from memory mapped flat weights created by convert_weights.py. Faster start up, less memory.")
+    m.add_argument("--prefetch", type=int, help="Number of input files decoded in background ahead of separation. 0 - decode in main thread. Default: 1", required=False, default=1)
+    m.add_argument("--writers", type=int, help="Number of threads writing output files in background. 0 - write in main thread. Default: 1", required=False, default=1)
+    m.add_argument("--workers", type=int, help="Number of worker processes for CPU. Models are loaded once and shared by workers, each of them processes whole files on its own CPUs. Default: 1", required=False, default=1)
+    m.add_argument("--shards", type=int, help="Split each file into this number of overlapping time shards separated in parallel worker processes (CPU). Useful for long files. Default: 1", required=False, default=1)
+    m.add_argument("--shard_overlap", type=float, help="Overlap of neighbour shards in seconds, stems are crossfaded there. Default: 10", required=False, default=10.0)
+    m.add_argument("--output_format", type=str, choices=['wav', 'flac', 'npy'], help="Format of output files: file per stem (wav, flac) or all stems of track in one memory mappable .npy [stems, channels, samples] with JSON sidecar (npy). Default: wav", required=False, default='wav')
+    m.add_argument("--output_subtype", type=str, choices=['FLOAT', 'PCM_16', 'PCM_24'], help="Sample format of output files. Default: FLOAT for wav and npy, PCM_24 for flac")
+    m.add_argument("--dither", type=str, choices=['tpdf', 'none'], help="Dither for PCM_16/PCM_24 outputs. Default: tpdf", required=False, default='tpdf')
+    m.add_argument("--flac_compression", type=int, choices=range(9), help="FLAC compression level from 0 (fastest) to 8 (smallest). Default: 5", required=False, default=5)
+    m.add_argument("--stream", action='store_true', help="Read audio from stdin and write stems to stdout or named pipes block by block. All logs go to stderr. Models are loaded once and kept in memory as with --large_gpu")
+    m.add_argument("--stream_input", type=str, help="Format of stdin: wav or raw PCM as format:sample rate:channels, format is s16le, s24le, s32le, f32le or f64le. Sample rate must be 44100. Default: wav", required=False, default='wav')
+    m.add_argument("--stream_stems", nargs='+', type=str, help="Stems written to stream outputs: bass, drums, other, vocals, instrum, instrum2. Default: vocals", required=False, default=['vocals'])
+    m.add_argument("--stream_output", nargs='+', type=str, help="Stream outputs: - (stdout) or paths of named pipes. One output gets all stems interleaved as channels, otherwise one output per stem. Default: -", required=False, default=['-'])
+    m.add_argument("--stream_output_format", type=str, choices=['wav', 'f32le', 's16le'], help="Format of stream outputs: WAV float32 with unknown length or raw PCM. Default: wav", required=False, default='wav')
+    m.add_argument("--stream_block", type=float, help="Length of stream blocks in seconds. Latency is about block + overlap / 2 plus separation time. Default: 30", required=False, default=30.0)
+    m.add_argument("--stream_overlap", type=float, help="Overlap of stream blocks in seconds, they are crossfaded there. Default: 5", required=False, default=5.0)
+    m.add_argument("--work_dir", type=str, help="Folder for checkpoints of per-model outputs and chunk progress. Rerun after crash resumes from the last finished model or chunk. Needs free disk space up to 72 bytes per sample of audio (1.9 GB per 10 min)")
+    m.add_argument("--spool_dir", type=str, help="Spool directory of work queue on shared filesystem. Without --enqueue this process works on jobs from it until queue is empty. Use --workers for several local workers")
+    m.add_argument("--enqueue", action='store_true', help="Add jobs from --input_audio or --manifest to --spool_dir queue and exit")
+    m.add_argument("--queue_status", action='store_true', help="Print queue depth and rates of workers of --spool_dir and exit")
+    m.add_argument("--heartbeat_timeout", type=float, help="Jobs of spool worker are returned to queue if its heartbeat didn't change for this number of seconds. Default: 60", required=False, default=60.0)
+    m.add_argument("--profile_startup", action='store_true', help="Print import time of heavy modules and time to first forward of model.")
 
     options = m.parse_args().__dict__
+    spool_worker = options['spool_dir'] is not None and not options['enqueue']
+    no_input = spool_worker or options['stream']
+    if options['manifest'] is None and options['input_audio'] is None and not no_input:
+        m.error('one of the arguments --input_audio/-i --manifest is required')
+    if options['manifest'] is None and options['output_folder'] is None and not no_input:
+        m.error('the following arguments are required: --output_folder/-r')
     print("Options: ".format(options))
     for el in options:
         print('{}: {}'.format(el, options[el]))
+    if options['profile_startup']:
+        profile_imports()
+        profile_first_forward(start_time)
+    if options['stream']:
+        options['stream_stdout'] = STREAM_STDOUT
     predict_with_model(options)
     print('Time: {:.0f} sec'.format(time() - start_time))
     print('Presented by https://mvsep.com')
@@ -911,4 +2696,12 @@ Example:
     --overlap_large 0.25
     --overlap_small 0.25
     --chunk_size 500000
+
+    python inference.py --manifest catalogue.jsonl --output_folder ./results/ --cpu --partition 0/4
+
+    python inference.py --manifest catalogue.jsonl --output_folder /mnt/share/results/ --spool_dir /mnt/share/spool/ --enqueue
+    python inference.py --spool_dir /mnt/share/spool/ --cpu --workers 4
+    python inference.py --spool_dir /mnt/share/spool/ --queue_status
+
+    ffmpeg -i song.mp3 -ar 44100 -f wav - | python inference.py --stream --cpu --stream_stems vocals | ffmpeg -i - vocals.flac
 """
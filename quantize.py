@@ -0,0 +1,208 @@
+# coding: utf-8
+__author__ = 'https://github.com/ZFTurbo/'
+
+# Offline INT8 quantization of models used in ensemble. Only useful for CPU inference.
+# Demucs models are quantized with dynamic quantization (Linear, LSTM and transformer
+# feed-forward layers), Kim ONNX models with onnxruntime dynamic quantization.
+# Each artifact is checked with accuracy gate on synthetic mixtures before it can be used
+# by inference.py with --quantized option.
+
+import os
+import copy
+import argparse
+import json
+from time import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from demucs.apply import apply_model
+import onnxruntime as ort
+
+from inference import get_model_folder, get_demucs_model, get_models, demix_full, \
+    md5, sdr, make_synthetic_mixture, torch_load, DEMUCS_MODELS, ONNX_MODELS_URL
+
+
+ONNX_MODELS = ['Kim_Vocal_1', 'Kim_Vocal_2', 'Kim_Inst']
+
+
+def quantize_demucs_model(model):
+    """
+    Returns dynamically quantized copy of model and number of quantized layers.
+    Convolutions are not supported by dynamic quantization, so they stay in float.
+    """
+    total = 0
+    for m in model.modules():
+        if type(m) in (nn.Linear, nn.LSTM):
+            total += 1
+    qmodel = torch.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+    return qmodel, total
+
+
+def quantize_onnx_model(path_in, path_out):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(path_in, path_out, weight_type=QuantType.QInt8)
+
+
+def demucs_stems(model, mixture):
+    audio = torch.from_numpy(mixture[None]).float()
+    with torch.no_grad():
+        # no random shifts, so float and quantized models see exactly the same input
+        out = apply_model(model, audio, shifts=0, overlap=0.25)[0].cpu().numpy()
+    stems = dict(zip(model.sources, out))
+    for extra in ['guitar', 'piano']:
+        if extra in stems:
+            stems['other'] = stems['other'] + stems.pop(extra)
+    return stems
+
+
+def onnx_stems(name, infer_session, mixture):
+    mdx_models = get_models('tdf_extra', load=False, device='cpu', vocals_model_type=2)
+    if name == 'Kim_Inst':
+        # it's instrumental so need to invert
+        instrum = -demix_full(-mixture, 'cpu', 200000000, mdx_models, infer_session, overlap=0.25)[0]
+        return {'vocals': mixture - instrum}
+    return {'vocals': demix_full(mixture, 'cpu', 200000000, mdx_models, infer_session, overlap=0.25)[0]}
+
+
+def accuracy_gate(separate_float, separate_quantized, mixtures, max_sdr_drop):
+    """
+    separate_* - functions which return dict of stems for given mixture
+    mixtures - list of (mixture, stems) pairs with known stems
+    """
+    sdr_float = []
+    sdr_quantized = []
+    sdr_agreement = []
+    time_float = 0
+    time_quantized = 0
+    for mixture, stems in mixtures:
+        start_time = time()
+        out_float = separate_float(mixture)
+        time_float += time() - start_time
+        start_time = time()
+        out_quantized = separate_quantized(mixture)
+        time_quantized += time() - start_time
+        for instr in out_float:
+            sdr_float.append(sdr(stems[instr], out_float[instr]))
+            sdr_quantized.append(sdr(stems[instr], out_quantized[instr]))
+            sdr_agreement.append(sdr(out_float[instr], out_quantized[instr]))
+    gate = {
+        'mixtures': len(mixtures),
+        'max_sdr_drop': max_sdr_drop,
+        'sdr_float': float(np.mean(sdr_float)),
+        'sdr_quantized': float(np.mean(sdr_quantized)),
+        'sdr_drop': float(np.mean(sdr_float) - np.mean(sdr_quantized)),
+        'sdr_quantized_vs_float': float(np.mean(sdr_agreement)),
+        'time_float': time_float,
+        'time_quantized': time_quantized,
+    }
+    return gate
+
+
+def save_metadata(path, meta):
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Gate: SDR float: {:.3f} SDR quantized: {:.3f} Drop: {:.3f} Speed up: {:.2f}x Passed: {}'.format(
+        meta['gate']['sdr_float'],
+        meta['gate']['sdr_quantized'],
+        meta['gate']['sdr_drop'],
+        meta['gate']['time_float'] / max(meta['gate']['time_quantized'], 1e-8),
+        meta['gate_passed'],
+    ))
+
+
+def process_demucs_model(name, model_folder, output_folder, mixtures, max_sdr_drop):
+    print('Quantize Demucs model: {}'.format(name))
+    model = get_demucs_model(name, model_folder, 'cpu')
+    model.eval()
+    path = output_folder + name + '.int8.th'
+    qmodel, total = quantize_demucs_model(model)
+    torch.save(qmodel, path)
+    # check exactly what will be loaded later by inference.py
+    qmodel = torch_load(path)
+    gate = accuracy_gate(
+        lambda mix: demucs_stems(model, mix),
+        lambda mix: demucs_stems(qmodel, mix),
+        mixtures,
+        max_sdr_drop,
+    )
+    meta = {
+        'source': name,
+        'quantization': 'dynamic int8',
+        'quantized_layers': total,
+        'torch_version': torch.__version__,
+        'quantized_engine': torch.backends.quantized.engine,
+        'created': time(),
+        'gate': gate,
+        'gate_passed': gate['sdr_drop'] <= max_sdr_drop,
+    }
+    save_metadata(path, meta)
+
+
+def process_onnx_model(name, model_folder, output_folder, mixtures, max_sdr_drop):
+    print('Quantize ONNX model: {}'.format(name))
+    path_float = model_folder + name + '.onnx'
+    if not os.path.isfile(path_float):
+        torch.hub.download_url_to_file(ONNX_MODELS_URL + name + '.onnx', path_float)
+    path = output_folder + name + '.int8.onnx'
+    quantize_onnx_model(path_float, path)
+    providers = ["CPUExecutionProvider"]
+    session_float = ort.InferenceSession(path_float, providers=providers)
+    session_quantized = ort.InferenceSession(path, providers=providers)
+    gate = accuracy_gate(
+        lambda mix: onnx_stems(name, session_float, mix),
+        lambda mix: onnx_stems(name, session_quantized, mix),
+        mixtures,
+        max_sdr_drop,
+    )
+    meta = {
+        'source': name,
+        'source_md5': md5(path_float),
+        'quantization': 'dynamic int8',
+        'onnxruntime_version': ort.__version__,
+        'created': time(),
+        'gate': gate,
+        'gate_passed': gate['sdr_drop'] <= max_sdr_drop,
+    }
+    save_metadata(path, meta)
+
+
+def quantize_models(options):
+    model_folder = get_model_folder()
+    output_folder = model_folder + 'quantized/'
+    if not os.path.isdir(output_folder):
+        os.mkdir(output_folder)
+
+    mixtures = [
+        make_synthetic_mixture(options['duration'], seed=i) for i in range(options['mixtures'])
+    ]
+    for name in options['models']:
+        if name in DEMUCS_MODELS:
+            process_demucs_model(name, model_folder, output_folder, mixtures, options['max_sdr_drop'])
+        elif name in ONNX_MODELS:
+            process_onnx_model(name, model_folder, output_folder, mixtures, options['max_sdr_drop'])
+        else:
+            print('Unknown model: {}. Skip it'.format(name))
+
+
+if __name__ == '__main__':
+    start_time = time()
+
+    m = argparse.ArgumentParser()
+    m.add_argument("--models", nargs='+', type=str, help="Models to quantize. Default: all models used in ensemble", default=DEMUCS_MODELS + ONNX_MODELS)
+    m.add_argument("--max_sdr_drop", type=float, help="Maximum allowed SDR drop (dB) comparing to float model. Default: 0.1", default=0.1)
+    m.add_argument("--mixtures", type=int, help="Number of synthetic mixtures for accuracy gate. Default: 4", default=4)
+    m.add_argument("--duration", type=float, help="Duration of each synthetic mixture in seconds. Default: 20", default=20.0)
+
+    options = m.parse_args().__dict__
+    for el in options:
+        print('{}: {}'.format(el, options[el]))
+    quantize_models(options)
+    print('Time: {:.0f} sec'.format(time() - start_time))
+
+
+"""
+Example:
+    python quantize.py --models htdemucs_ft Kim_Vocal_2 --max_sdr_drop 0.1
+    python inference.py --input_audio mixture.wav --output_folder ./results/ --cpu --quantized
+"""
@@ -4,13 +4,8 @@ import os
 import time
 import numpy as np
 import tempfile
-from scipy.io import wavfile
 import gradio as gr
 from inference import EnsembleDemucsMDXMusicSeparationModel, predict_with_model
-import torch
-import librosa
-import librosa.display
-import matplotlib.pyplot as plt
 import asyncio
 
 # prevent connection from being closed after inference (windows Error)
@@ -18,12 +13,6 @@ if os.name == 'nt':
     # Change  event loop policy to SelectorEventLoop instead of the default ProactorEventLoop
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-
-if torch.cuda.is_available():
-    print("CUDA is available!")
-else:
-    print("CUDA is not available.")
-
 def check_file_readiness(filepath):
     # If the loop finished, it means the file size has not changed for 5 seconds
     # which indicates that the file is ready
@@ -40,6 +29,10 @@ def check_file_readiness(filepath):
     return True
 
 def generate_spectrogram(audio_file_path):
+    # heavy modules are imported on first use, so web-ui starts faster
+    import librosa
+    import librosa.display
+    import matplotlib.pyplot as plt
     y, sr = librosa.load(audio_file_path)
     plt.figure(figsize=(10, 4))
     S = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, fmax=8000)
@@ -60,6 +53,12 @@ def generate_spectrograms(audio_files):
     return tuple(output_spectrograms)
 
 def separate_music_file_wrapper(input_audio, use_cpu, use_single_onnx, large_overlap, small_overlap, chunk_size, use_large_gpu):
+    import torch
+    from scipy.io import wavfile
+    if torch.cuda.is_available():
+        print("CUDA is available!")
+    else:
+        print("CUDA is not available.")
     print(f"type(input_audio): {type(input_audio)}, input_audio: {input_audio[:10]}") # truncate printout
     sample_rate, audio_data = input_audio
     output_file = "input_audio.wav"